@@ -0,0 +1,5 @@
+import os
+
+# Overriding Dynaconf settings
+os.environ['SETTINGS_FILE_FOR_DYNACONF'] = '["settings.toml", "secrets.toml"]'
+os.environ['ENVVAR_PREFIX_FOR_DYNACONF'] = "false"
@@ -0,0 +1,177 @@
+"""Load and latency benchmarks for every route of the SSO service
+
+Usage:
+    python -m benchmarks run [--concurrency 16] [--requests 500] [--users 1000,100000] [--only verify,sso] [--output bench.json]
+    python -m benchmarks compare baseline.json bench.json [--threshold 0.1]
+"""
+import sys
+import time
+import asyncio
+import argparse
+import platform
+import statistics
+import tracemalloc
+from typing import List
+import orjson
+from sso_service.config import APP_VERSION
+from sso_service.database import Database
+from sso_service.embedded import EmbeddedStorage
+from sso_service.main import app
+from sso_service.migrations import ensure_indexes
+from sso_service.models import registered_service_repo
+from sso_service.utils.passwords import PasswordPool
+from .asgi import ASGIClient
+from .scenarios import SCENARIOS, Context, Request, list_users
+
+ALLOCATION_SAMPLES = 20
+COMPARED_METRICS = {"throughput_rps": 1, "p50_ms": -1, "p95_ms": -1, "p99_ms": -1, "peak_kib_per_request": -1}
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+async def fresh_context() -> Context:
+    Database.storage = EmbeddedStorage()
+    await ensure_indexes()
+    service = await registered_service_repo.insert({"name": "benchmark"})
+    return Context(api_key=service.api_key)
+
+
+def send(client: ASGIClient, method: str, url: str, body, api_key: str):
+    if isinstance(body, bytes):
+        return client.request(method, url, content=body, api_key=api_key)
+    return client.request(method, url, json=body, api_key=api_key)
+
+
+async def measure(client: ASGIClient, requests: List[Request], concurrency: int) -> dict:
+    latencies = []
+    errors = 0
+    pending = iter(requests)
+
+    async def worker():
+        nonlocal errors
+        for method, url, body, expected, api_key in pending:
+            start = time.perf_counter()
+            status, _ = await send(client, method, url, body, api_key)
+            latencies.append(time.perf_counter() - start)
+            if status != expected:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+    }
+
+
+async def measure_allocations(client: ASGIClient, requests: List[Request]) -> float:
+    """Peak traced memory growth per request, sampled sequentially"""
+    peaks = []
+    tracemalloc.start()
+    try:
+        for method, url, body, _, api_key in requests:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            await send(client, method, url, body, api_key)
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    return statistics.mean(peaks) / 1024 if peaks else 0.0
+
+
+async def run_scenario(ctx: Context, name: str, prepare, args) -> dict:
+    client = ASGIClient(app, api_key=ctx.api_key)
+    requests = await prepare(ctx, args.requests + ALLOCATION_SAMPLES)
+    result = await measure(client, requests[:args.requests], args.concurrency)
+    result["peak_kib_per_request"] = await measure_allocations(client, requests[args.requests:])
+    print(
+        f"{name:<28} {result['throughput_rps']:>9.1f} rps  p50 {result['p50_ms']:>8.2f} ms  "
+        f"p95 {result['p95_ms']:>8.2f} ms  p99 {result['p99_ms']:>8.2f} ms  "
+        f"{result['peak_kib_per_request']:>8.1f} KiB/req  errors {result['errors']}"
+    )
+    return result
+
+
+async def run(args) -> dict:
+    only = set(args.only.split(",")) if args.only else None
+    results = {}
+    await PasswordPool.start()
+    try:
+        for size in map(int, args.users.split(",")):
+            for stream in (False, True):
+                name = f"list_users{'_stream' if stream else ''}_{size}"
+                if only and name not in only and "list_users" not in only:
+                    continue
+                ctx = await fresh_context()
+                await ctx.create_users(size, with_token=False)
+                results[name] = await run_scenario(ctx, name, list_users(stream), args)
+        ctx = await fresh_context()
+        for name, prepare in SCENARIOS.items():
+            if not only or name in only:
+                results[name] = await run_scenario(ctx, name, prepare, args)
+    finally:
+        await PasswordPool.stop()
+    return {
+        "meta": {
+            "app_version": APP_VERSION,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.time(),
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+        },
+        "results": results,
+    }
+
+
+def compare(args) -> int:
+    with open(args.baseline, "rb") as f:
+        baseline = orjson.loads(f.read())["results"]
+    with open(args.current, "rb") as f:
+        current = orjson.loads(f.read())["results"]
+    regressions = 0
+    for name in sorted(set(baseline) & set(current)):
+        for metric, direction in COMPARED_METRICS.items():
+            old, new = baseline[name].get(metric), current[name].get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            regressed = change * direction < -args.threshold
+            regressions += regressed
+            print(f"{name:<28} {metric:<22} {old:>10.2f} -> {new:>10.2f} ({change:+.1%}){'  REGRESSION' if regressed else ''}")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LemonSSO benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Esegue i benchmark")
+    run_parser.add_argument("--concurrency", type=int, default=16)
+    run_parser.add_argument("--requests", type=int, default=500)
+    run_parser.add_argument("--users", default="1000,100000", help="Dimensioni della collezione utenti per list_users")
+    run_parser.add_argument("--only", default=None, help="Scenari da eseguire separati da virgola")
+    run_parser.add_argument("--output", default=None, help="File JSON dei risultati")
+    compare_parser = subparsers.add_parser("compare", help="Confronta due file di risultati")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="Variazione tollerata prima di segnalare una regressione")
+    args = parser.parse_args()
+    if args.command == "compare":
+        sys.exit(compare(args))
+    report = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Minimal in-process ASGI HTTP driver, no network and no extra dependencies"""
+import asyncio
+from typing import Optional, Tuple
+import orjson
+
+
+class ASGIClient:
+    def __init__(self, app, api_key: Optional[str] = None):
+        self.app = app
+        self.api_key = api_key
+
+    async def request(self, method: str, url: str, json=None, api_key: Optional[str] = None, content: bytes = None) -> Tuple[int, bytes]:
+        path, _, query = url.partition("?")
+        body = content if content is not None else orjson.dumps(json) if json is not None else b""
+        headers = [(b"host", b"benchmark"), (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+        if api_key or self.api_key:
+            headers.append((b"x-api-key", (api_key or self.api_key).encode()))
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": query.encode(),
+            "root_path": "",
+            "headers": headers,
+            "client": ("127.0.0.1", 0),
+            "server": ("benchmark", 80),
+        }
+        sent = False
+        disconnected = asyncio.Event()
+        status = 0
+        chunks = []
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    disconnected.set()
+
+        await self.app(scope, receive, send)
+        return status, b"".join(chunks)
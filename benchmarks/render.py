@@ -0,0 +1,85 @@
+"""Per-response CPU cost of rendering users, before and after the fast rendering path
+
+Usage:
+    python -m benchmarks.render [--iterations 20000]
+"""
+import time
+import asyncio
+import argparse
+from dynaconf import settings
+from fastapi.responses import ORJSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+from sso_service.models import User, UserToken
+from sso_service.serializers import ReadUser, AuthenticatedUser, encode_read_user, encode_authenticated_user
+from sso_service.utils.response import DJSONResponse
+
+
+class LegacyDJSONResponse(ORJSONResponse):
+    """DJSONResponse as it was before the fast rendering path"""
+    media_type = "application/json; charset=utf-8"
+    body_meta_code = "OK"
+    body_meta_message = "Operation Done"
+
+    def __init__(self, content=None, status_code: int = 200) -> None:
+        self.body_meta_extra = {}
+        super().__init__(content=content, status_code=status_code)
+
+    @property
+    def body_metadata(self):
+        return {
+            "error": self.status_code >= 400,
+            "version": settings.get("APP_VERSION"),
+            "code": self.body_meta_code,
+            "message": self.body_meta_message
+        }
+
+    def wrap_content(self, content):
+        out = {
+            "meta": dict(**self.body_metadata, **self.body_meta_extra) if self.body_meta_extra else self.body_metadata,
+        }
+        out['data'] = content
+        return out
+
+    def render(self, content) -> bytes:
+        return super().render(self.wrap_content(content))
+
+
+async def legacy(field, content, iterations: int) -> float:
+    start = time.process_time()
+    for _ in range(iterations):
+        LegacyDJSONResponse(content=await serialize_response(field=field, response_content=content))
+    return time.process_time() - start
+
+
+async def current(encoder, content, iterations: int) -> float:
+    start = time.process_time()
+    for _ in range(iterations):
+        DJSONResponse(content=encoder(content))
+    return time.process_time() - start
+
+
+async def run(iterations: int):
+    user = User(username="benchmark", password="$2b$12$" + "x" * 53, token=UserToken(is_valid=True))
+    authenticated = {"user": user, "auth": {"token": user.token.access_value, "refresh": user.token.refresh_value}}
+    cases = [
+        ("ReadUser", create_response_field(name="read_user", type_=ReadUser), encode_read_user, user),
+        ("AuthenticatedUser", create_response_field(name="authenticated_user", type_=AuthenticatedUser), encode_authenticated_user, authenticated),
+    ]
+    for name, field, encoder, content in cases:
+        before = await legacy(field, content, iterations)
+        after = await current(encoder, content, iterations)
+        print(
+            f"{name:<18} before {before / iterations * 1e6:>8.2f} µs/response  "
+            f"after {after / iterations * 1e6:>8.2f} µs/response  ({before / after:.1f}x)"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LemonSSO response rendering microbenchmark")
+    parser.add_argument("--iterations", type=int, default=20000)
+    asyncio.run(run(parser.parse_args().iterations))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""Benchmark scenarios, one per route of ``sso_service.web_services``
+
+Every scenario prepares the requests it needs up front (seeding the DB directly, without bcrypt
+where possible) so that single-use resources like refresh tokens are never replayed.
+"""
+import itertools
+from typing import Awaitable, Callable, Dict, List, Tuple, Union
+import orjson
+from sso_service import sso
+from sso_service.config import ADMIN_APIKEY, password_context
+from sso_service.migrations import WarmUp
+from sso_service.models import User, user_repo, registered_service_repo
+
+PASSWORD = "Benchmark1!"
+SEED_BATCH = 10000
+BATCH_ITEMS = 50
+IMPORT_ROWS = 4
+
+# A bytes body is sent as is, any other as JSON
+Request = Tuple[str, str, Union[dict, bytes], int, str]
+Prepare = Callable[["Context", int], Awaitable[List[Request]]]
+
+
+class Context:
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self.password_hash = password_context.hash(PASSWORD.encode("utf-8"))
+        self.sequence = itertools.count()
+
+    async def create_users(self, count: int, with_token: bool = True) -> List[User]:
+        prefix = f"bench{next(self.sequence)}_"
+        users = [User(username=f"{prefix}{i}", password=self.password_hash) for i in range(count)]
+        for start in range(0, count, SEED_BATCH):
+            await user_repo.insert_many(users[start:start + SEED_BATCH])
+        if with_token:
+            users = [await sso.renew_auth(user) for user in users]
+        return users
+
+
+def _service(method: str, url: str, body: dict = None, expected: int = 200) -> Request:
+    return method, url, body, expected, None
+
+
+def _admin(method: str, url: str, body: dict = None, expected: int = 200) -> Request:
+    return method, url, body, expected, ADMIN_APIKEY
+
+
+async def echo(ctx: Context, count: int) -> List[Request]:
+    return [_service("GET", "/api/v1/echo/")] * count
+
+
+async def create_registered_service(ctx: Context, count: int) -> List[Request]:
+    return [_admin("POST", "/api/v1/registerd-services", {"name": f"service{i}"}, 201) for i in range(count)]
+
+
+async def list_registered_services(ctx: Context, count: int) -> List[Request]:
+    return [_admin("GET", "/api/v1/registered-services")] * count
+
+
+async def delete_registered_service(ctx: Context, count: int) -> List[Request]:
+    services = [await registered_service_repo.insert({"name": f"disposable{i}"}) for i in range(count)]
+    return [_admin("DELETE", f"/api/v1/registered-services/{service.id}") for service in services]
+
+
+async def runtime_stats(ctx: Context, count: int) -> List[Request]:
+    return [_admin("GET", "/api/v1/stats")] * count
+
+
+async def prometheus_metrics(ctx: Context, count: int) -> List[Request]:
+    return [_admin("GET", "/api/v1/metrics")] * count
+
+
+async def liveness(ctx: Context, count: int) -> List[Request]:
+    return [_service("GET", "/health/live")] * count
+
+
+async def readiness(ctx: Context, count: int) -> List[Request]:
+    await WarmUp.start()
+    return [_service("GET", "/health/ready")] * count
+
+
+async def create_user(ctx: Context, count: int) -> List[Request]:
+    prefix = f"signup{next(ctx.sequence)}_"
+    return [_service("POST", "/api/v1/users/", {"username": f"{prefix}{i}", "password": PASSWORD}, 201) for i in range(count)]
+
+
+async def update_user(ctx: Context, count: int) -> List[Request]:
+    users = await ctx.create_users(count, with_token=False)
+    return [_service("PUT", f"/api/v1/users/{user.id}", {"username": f"{user.username}_renamed"}) for user in users]
+
+
+async def retrieve_user(ctx: Context, count: int) -> List[Request]:
+    users = await ctx.create_users(min(count, 1000), with_token=False)
+    return [_service("GET", f"/api/v1/users/{user.id}") for user in itertools.islice(itertools.cycle(users), count)]
+
+
+async def delete_user(ctx: Context, count: int) -> List[Request]:
+    users = await ctx.create_users(count, with_token=False)
+    return [_service("DELETE", f"/api/v1/users/{user.id}") for user in users]
+
+
+async def import_users(ctx: Context, count: int) -> List[Request]:
+    prefix = f"import{next(ctx.sequence)}_"
+    return [
+        _admin("POST", "/api/v1/users/import", b"".join(
+            orjson.dumps({"username": f"{prefix}{i}_{row}", "password": PASSWORD}) + b"\n" for row in range(IMPORT_ROWS)
+        ))
+        for i in range(count)
+    ]
+
+
+async def retrieve_users_batch(ctx: Context, count: int) -> List[Request]:
+    users = await ctx.create_users(min(count * BATCH_ITEMS, 1000), with_token=False)
+    ids = itertools.cycle([str(user.id) for user in users])
+    return [_service("POST", "/api/v1/users/retrieve-batch", {"ids": list(itertools.islice(ids, BATCH_ITEMS))}) for _ in range(count)]
+
+
+async def delete_users_batch(ctx: Context, count: int) -> List[Request]:
+    users = await ctx.create_users(count * BATCH_ITEMS, with_token=False)
+    return [
+        _service("POST", "/api/v1/users/delete-batch", {"ids": [str(user.id) for user in users[start:start + BATCH_ITEMS]]})
+        for start in range(0, len(users), BATCH_ITEMS)
+    ]
+
+
+async def update_users_batch(ctx: Context, count: int) -> List[Request]:
+    users = await ctx.create_users(count * BATCH_ITEMS, with_token=False)
+    return [
+        _service("POST", "/api/v1/users/update-batch", {"users": [
+            {"id": str(user.id), "username": f"{user.username}_renamed"} for user in users[start:start + BATCH_ITEMS]
+        ]})
+        for start in range(0, len(users), BATCH_ITEMS)
+    ]
+
+
+async def signin(ctx: Context, count: int) -> List[Request]:
+    users = await ctx.create_users(min(count, 1000))
+    return [
+        _service("POST", "/api/v1/auth/signin", {"username": user.username, "password": PASSWORD})
+        for user in itertools.islice(itertools.cycle(users), count)
+    ]
+
+
+async def ues(ctx: Context, count: int) -> List[Request]:
+    users = await ctx.create_users(min(count, 1000))
+    return [_service("POST", "/api/v1/auth/ues", {"username": user.username}) for user in itertools.islice(itertools.cycle(users), count)]
+
+
+async def signout(ctx: Context, count: int) -> List[Request]:
+    users = await ctx.create_users(count)
+    return [_service("POST", "/api/v1/auth/signout", {"access_token": user.token.access_value}) for user in users]
+
+
+async def verify(ctx: Context, count: int) -> List[Request]:
+    users = await ctx.create_users(min(count, 1000))
+    return [
+        _service("POST", "/api/v1/auth/verify", {"access_token": user.token.access_value})
+        for user in itertools.islice(itertools.cycle(users), count)
+    ]
+
+
+async def verify_batch(ctx: Context, count: int) -> List[Request]:
+    users = await ctx.create_users(min(count, 1000))
+    tokens = itertools.cycle([user.token.access_value for user in users])
+    return [
+        _service("POST", "/api/v1/auth/verify-batch", {"access_tokens": list(itertools.islice(tokens, 50))})
+        for _ in range(count)
+    ]
+
+
+async def single_sign_on(ctx: Context, count: int) -> List[Request]:
+    users = await ctx.create_users(min(count, 1000))
+    return [
+        _service("POST", "/api/v1/auth/sso", {"access_token": user.token.access_value})
+        for user in itertools.islice(itertools.cycle(users), count)
+    ]
+
+
+async def refresh(ctx: Context, count: int) -> List[Request]:
+    users = await ctx.create_users(count)
+    return [_service("POST", "/api/v1/auth/refresh", {"refresh_token": user.token.refresh_value}) for user in users]
+
+
+SCENARIOS: Dict[str, Prepare] = {
+    "echo": echo,
+    "create_registered_service": create_registered_service,
+    "list_registered_services": list_registered_services,
+    "delete_registered_service": delete_registered_service,
+    "stats": runtime_stats,
+    "metrics": prometheus_metrics,
+    "health_live": liveness,
+    "health_ready": readiness,
+    "create_user": create_user,
+    "update_user": update_user,
+    "retrieve_user": retrieve_user,
+    "delete_user": delete_user,
+    "import_users": import_users,
+    "retrieve_users_batch": retrieve_users_batch,
+    "delete_users_batch": delete_users_batch,
+    "update_users_batch": update_users_batch,
+    "signin": signin,
+    "ues": ues,
+    "signout": signout,
+    "verify": verify,
+    "verify_batch": verify_batch,
+    "sso": single_sign_on,
+    "refresh": refresh,
+}
+
+
+def list_users(stream: bool) -> Prepare:
+    async def prepare(ctx: Context, count: int) -> List[Request]:
+        return [_service("GET", "/api/v1/users/" + ("?stream=true" if stream else ""))] * count
+    return prepare
@@ -1,4 +1,5 @@
 import os
+import shutil
 import multiprocessing
 
 # Overriding Dynaconf settings
@@ -9,7 +10,17 @@ from dynaconf import settings
 # Getting Env Vars
 SERVER_BINDS = str(settings.get("SERVER_BINDS", "localhost:8000")).split(";")
 LOGLEVEL = settings.get("SERVER_LOGLEVEL", "info")
-WORKERS = settings.get("SERVER_WORKERS_NUM", (multiprocessing.cpu_count() * 2) + 1)
+EMBEDDED = settings.get("STORAGE_BACKEND", "mongo") == "embedded"
+WORKERS = int(settings.get("SERVER_WORKERS_NUM", 1 if EMBEDDED else (multiprocessing.cpu_count() * 2) + 1))
+if EMBEDDED and WORKERS != 1:
+    # The embedded storage log is locked by the process owning it, other workers could not open it
+    raise RuntimeError("The embedded storage is owned by a single process, set SERVER_WORKERS_NUM=1")
+METRICS_MULTIPROC_DIR = settings.get("METRICS_MULTIPROC_DIR", "/tmp/lemonsso-metrics")
+
+# Prometheus multiprocess mode: every worker writes its samples in a shared directory
+shutil.rmtree(METRICS_MULTIPROC_DIR, ignore_errors=True)
+os.makedirs(METRICS_MULTIPROC_DIR, exist_ok=True)
+os.environ["PROMETHEUS_MULTIPROC_DIR"] = METRICS_MULTIPROC_DIR
 
 
 bind = SERVER_BINDS
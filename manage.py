@@ -0,0 +1,112 @@
+import os
+import sys
+import asyncio
+import argparse
+import orjson
+from typing import Any, Awaitable, Callable, NamedTuple, Sequence
+
+# Overriding Dynaconf settings
+os.environ['SETTINGS_FILE_FOR_DYNACONF'] = '["settings.toml", "secrets.toml"]'
+os.environ['ENVVAR_PREFIX_FOR_DYNACONF'] = "false"
+
+from sso_service.database import Database
+from sso_service import migrations, importer, sweeper, password_costs
+from sso_service.config import PASSWORD_BCRYPT_ROUNDS
+from sso_service.utils.passwords import calibrate_rounds
+
+
+async def ensure_indexes(args):
+    await migrations.ensure_indexes()
+
+
+async def index_stats(args):
+    await migrations.log_index_sizes()
+
+
+async def backfill_token_keys(args):
+    await migrations.log_index_sizes()
+    await migrations.backfill_token_keys(args.batch_size)
+    await migrations.ensure_indexes()
+    await migrations.log_index_sizes()
+
+
+async def backfill_token_expiry(args):
+    await migrations.backfill_token_expiry(args.batch_size)
+    await migrations.ensure_indexes()
+
+
+async def import_users(args):
+    with open(args.file, encoding="utf-8", newline="") as lines:
+        async for result in importer.import_users(lines, fmt=args.format, batch_size=args.batch_size):
+            sys.stdout.buffer.write(orjson.dumps(result) + b"\n")
+
+
+async def sweep_tokens(args):
+    await sweeper.sweep(args.batch_size)
+
+
+async def calibrate_bcrypt(args):
+    rounds, estimates = calibrate_rounds(args.target_ms / 1000, samples=args.samples)
+    for cost, seconds in estimates.items():
+        marks = ("  <- consigliato" if cost == rounds else "") + ("  <- attuale" if cost == PASSWORD_BCRYPT_ROUNDS else "")
+        print(f"rounds {cost:>2}: {seconds * 1000:>10.1f} ms{marks}")
+    print(f"PASSWORD_BCRYPT_ROUNDS={rounds}")
+
+
+async def show_password_costs(args):
+    for rounds, users in sorted((await password_costs.refresh()).items()):
+        print(f"rounds {rounds:>2}: {users} utenti")
+
+
+class Command(NamedTuple):
+    """Management command, ``arguments`` being ``(flags, options)`` pairs of ``add_argument``"""
+    fn: Callable[[argparse.Namespace], Awaitable[Any]]
+    help: str
+    arguments: Sequence[tuple] = ()
+    needs_db: bool = True
+
+
+BATCH_SIZE = (("--batch-size",), {"type": int, "default": 1000})
+
+COMMANDS = {
+    "ensure-indexes": Command(ensure_indexes, "Crea o riconcilia gli indici MongoDB"),
+    "index-stats": Command(index_stats, "Mostra la dimensione degli indici MongoDB"),
+    "backfill-token-keys": Command(backfill_token_keys, "Salva le chiavi digest dei token emessi prima della loro introduzione", [BATCH_SIZE]),
+    "backfill-token-expiry": Command(backfill_token_expiry, "Salva la scadenza dei token emessi prima della sua introduzione", [BATCH_SIZE]),
+    "sweep-tokens": Command(sweep_tokens, "Elimina o invalida i token scaduti", [BATCH_SIZE]),
+    "calibrate-bcrypt": Command(calibrate_bcrypt, "Misura bcrypt su questo host e consiglia i rounds per una latenza obiettivo", [
+        (("--target-ms",), {"type": float, "default": 250}),
+        (("--samples",), {"type": int, "default": 3}),
+    ], needs_db=False),
+    "password-costs": Command(show_password_costs, "Mostra la distribuzione degli utenti per costo dell'hash della password"),
+    "import-users": Command(import_users, "Importa utenti in blocco da un file CSV o NDJSON, stampando l'esito di ogni riga", [
+        (("file",), {}),
+        (("--format",), {"choices": ["ndjson", "csv"], "default": "ndjson"}),
+        (("--batch-size",), {"type": int, "default": 500}),
+    ]),
+}
+
+
+async def run(args):
+    command = COMMANDS[args.command]
+    if not command.needs_db:
+        return await command.fn(args)
+    await Database.connect()
+    try:
+        await command.fn(args)
+    finally:
+        await Database.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LemonSSO management commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, command in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=command.help)
+        for flags, options in command.arguments:
+            subparser.add_argument(*flags, **options)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
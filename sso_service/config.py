@@ -1,8 +1,17 @@
+import os
+import tempfile
 from dynaconf import settings
 from passlib.context import CryptContext
 
 
-password_context = CryptContext(schemes=["bcrypt"], deprecated=["auto"])
+# Hashes with a different cost factor are deprecated and upgraded on login
+PASSWORD_BCRYPT_ROUNDS = int(settings.get("PASSWORD_BCRYPT_ROUNDS", 12))
+password_context = CryptContext(
+    schemes=["bcrypt"], deprecated=["auto"],
+    bcrypt__default_rounds=PASSWORD_BCRYPT_ROUNDS,
+    bcrypt__min_rounds=PASSWORD_BCRYPT_ROUNDS,
+    bcrypt__max_rounds=PASSWORD_BCRYPT_ROUNDS
+)
 
 APP_VERSION = "1.2.4"
 settings['APP_VERSION'] = APP_VERSION
@@ -10,3 +19,87 @@ DEBUG = settings.get("DEBUG", False)
 MONGO_URL = settings.get("MONGO_URL", "mongodb://localhost:27017/lemonSSO")
 MONGO_DATABASE = settings.get("MONGO_DATABASE", "lemonSSO")
 ADMIN_APIKEY = settings.get("ADMIN_APIKEY", "test_api_key")
+MONGO_ENSURE_INDEXES = settings.get("MONGO_ENSURE_INDEXES", True)
+
+# Storage backend: "mongo" or "embedded" (in-process, single worker)
+STORAGE_BACKEND = settings.get("STORAGE_BACKEND", "mongo")
+EMBEDDED_STORAGE_PATH = settings.get("EMBEDDED_STORAGE_PATH", "data/lemonsso.bson")
+EMBEDDED_STORAGE_FSYNC = settings.get("EMBEDDED_STORAGE_FSYNC", False)
+EMBEDDED_STORAGE_COMPACT_RATIO = float(settings.get("EMBEDDED_STORAGE_COMPACT_RATIO", 4))
+
+# MongoDB connection pool
+MONGO_MAX_POOL_SIZE = int(settings.get("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(settings.get("MONGO_MIN_POOL_SIZE", 4))
+MONGO_MAX_IDLE_TIME_MS = settings.get("MONGO_MAX_IDLE_TIME_MS", None)
+MONGO_CONNECT_TIMEOUT_MS = int(settings.get("MONGO_CONNECT_TIMEOUT_MS", 20000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(settings.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 30000))
+MONGO_SOCKET_TIMEOUT_MS = settings.get("MONGO_SOCKET_TIMEOUT_MS", None)
+MONGO_WAIT_QUEUE_TIMEOUT_MS = settings.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", None)
+MONGO_COMPRESSORS = settings.get("MONGO_COMPRESSORS", "")
+MONGO_WARM_UP = settings.get("MONGO_WARM_UP", True)
+HEALTH_PING_TIMEOUT = float(settings.get("HEALTH_PING_TIMEOUT", 2))
+
+# Password hashing pool
+PASSWORD_EXECUTOR = settings.get("PASSWORD_EXECUTOR", "thread")
+PASSWORD_WORKERS = int(settings.get("PASSWORD_WORKERS", 2))
+PASSWORD_QUEUE_SIZE = int(settings.get("PASSWORD_QUEUE_SIZE", 64))
+PASSWORD_REHASH_ON_LOGIN = settings.get("PASSWORD_REHASH_ON_LOGIN", True)
+PASSWORD_COST_STATS_INTERVAL = float(settings.get("PASSWORD_COST_STATS_INTERVAL", 900))
+
+# Registered services API key cache
+API_KEY_CACHE_SIZE = int(settings.get("API_KEY_CACHE_SIZE", 1024))
+API_KEY_CACHE_TTL = float(settings.get("API_KEY_CACHE_TTL", 300))
+API_KEY_CACHE_NEGATIVE_TTL = float(settings.get("API_KEY_CACHE_NEGATIVE_TTL", 5))
+API_KEY_CACHE_NEGATIVE_SIZE = int(settings.get("API_KEY_CACHE_NEGATIVE_SIZE", 256))
+
+# Access token verification cache
+TOKEN_CACHE_SIZE = int(settings.get("TOKEN_CACHE_SIZE", 10000))
+TOKEN_CACHE_MAX_STALENESS = float(settings.get("TOKEN_CACHE_MAX_STALENESS", 30))
+VERIFY_BATCH_MAX_TOKENS = int(settings.get("VERIFY_BATCH_MAX_TOKENS", 100))
+
+# Collections pagination and streaming
+PAGINATION_DEFAULT_LIMIT = int(settings.get("PAGINATION_DEFAULT_LIMIT", 100))
+PAGINATION_MAX_LIMIT = int(settings.get("PAGINATION_MAX_LIMIT", 1000))
+STREAM_BATCH_SIZE = int(settings.get("STREAM_BATCH_SIZE", 500))
+USERS_BATCH_MAX_ITEMS = int(settings.get("USERS_BATCH_MAX_ITEMS", 500))
+
+# Access tokens format and signing keys
+TOKEN_FORMAT = settings.get("TOKEN_FORMAT", "opaque")
+TOKEN_SIGNING_KEYS = dict(settings.get("TOKEN_SIGNING_KEYS", {}))
+TOKEN_SIGNING_KEY_ID = settings.get("TOKEN_SIGNING_KEY_ID", None)
+TOKEN_LOOKUP_LEGACY = settings.get("TOKEN_LOOKUP_LEGACY", True)
+TOKEN_EXPIRY_LEGACY = settings.get("TOKEN_EXPIRY_LEGACY", True)
+TOKEN_EXPIRY_BACKFILL = settings.get("TOKEN_EXPIRY_BACKFILL", True)
+
+# Bulk users import
+IMPORT_BATCH_SIZE = int(settings.get("IMPORT_BATCH_SIZE", 500))
+IMPORT_HASH_WORKERS = int(settings.get("IMPORT_HASH_WORKERS", PASSWORD_WORKERS))
+
+# Expired tokens sweeper
+TOKEN_SWEEPER_ENABLED = settings.get("TOKEN_SWEEPER_ENABLED", True)
+TOKEN_SWEEPER_INTERVAL = float(settings.get("TOKEN_SWEEPER_INTERVAL", 300))
+TOKEN_SWEEPER_BATCH_SIZE = int(settings.get("TOKEN_SWEEPER_BATCH_SIZE", 1000))
+
+# Failed login throttling
+LOGIN_THROTTLE_ENABLED = settings.get("LOGIN_THROTTLE_ENABLED", True)
+LOGIN_THROTTLE_BACKEND = settings.get("LOGIN_THROTTLE_BACKEND", "memory")
+LOGIN_THROTTLE_WINDOW = float(settings.get("LOGIN_THROTTLE_WINDOW", 60))
+LOGIN_THROTTLE_USERNAME_LIMIT = int(settings.get("LOGIN_THROTTLE_USERNAME_LIMIT", 10))
+LOGIN_THROTTLE_SERVICE_LIMIT = int(settings.get("LOGIN_THROTTLE_SERVICE_LIMIT", 300))
+LOGIN_THROTTLE_MAX_KEYS = int(settings.get("LOGIN_THROTTLE_MAX_KEYS", 100000))
+
+# Request tracing: slow requests log and sampled JSON lines export
+TRACING_ENABLED = settings.get("TRACING_ENABLED", False)
+TRACING_SLOW_THRESHOLD = float(settings.get("TRACING_SLOW_THRESHOLD", 0.5))
+TRACING_SAMPLE_RATE = float(settings.get("TRACING_SAMPLE_RATE", 0))
+TRACING_EXPORT_PATH = settings.get("TRACING_EXPORT_PATH", "traces/lemonsso.jsonl")
+
+# Revoked access tokens filter shared by the workers of a host
+REVOCATION_FILTER_ENABLED = settings.get("REVOCATION_FILTER_ENABLED", True)
+REVOCATION_FILTER_PATH = settings.get(
+    "REVOCATION_FILTER_PATH",
+    os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), f"lemonsso-{MONGO_DATABASE}-revocations")
+)
+REVOCATION_FILTER_SIZE = int(settings.get("REVOCATION_FILTER_SIZE", 1024 * 1024))
+REVOCATION_FILTER_HASHES = min(int(settings.get("REVOCATION_FILTER_HASHES", 7)), 16)
+REVOCATION_FILTER_ROTATION = float(settings.get("REVOCATION_FILTER_ROTATION", 0))
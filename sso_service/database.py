@@ -1,80 +1,315 @@
 import os
+import time
+import asyncio
 import datetime
+import threading
 from loguru import logger
-from typing import Optional
-from odmantic import AIOEngine, Model, ObjectId
+from functools import lru_cache
+from typing import Any, AsyncIterator, Awaitable, Dict, List, NamedTuple, Optional, Tuple, Type, Union
+from odmantic import Model, ObjectId
+from odmantic.query import and_
+from pymongo import IndexModel, ASCENDING
+from pymongo.monitoring import ConnectionPoolListener
 from motor.motor_asyncio import AsyncIOMotorClient
-from .config import MONGO_URL, MONGO_DATABASE
-from .utils.exceptions import Gone
+from .config import (
+    MONGO_URL, MONGO_DATABASE, STREAM_BATCH_SIZE, MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_MAX_IDLE_TIME_MS,
+    MONGO_CONNECT_TIMEOUT_MS, MONGO_SERVER_SELECTION_TIMEOUT_MS, MONGO_SOCKET_TIMEOUT_MS, MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    MONGO_COMPRESSORS, HEALTH_PING_TIMEOUT, STORAGE_BACKEND, EMBEDDED_STORAGE_PATH, EMBEDDED_STORAGE_FSYNC,
+    EMBEDDED_STORAGE_COMPACT_RATIO
+)
+from .storage import Storage, MongoStorage
+from .embedded import EmbeddedStorage
+from .utils.exceptions import Gone, BadRequest
+from .utils.metrics import observe_query, observe_pool_wait
+from .utils.tracing import span
+
+
+def client_options() -> dict:
+    """Connection pool, timeouts and compression options of the MongoDB client"""
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "socketTimeoutMS": MONGO_SOCKET_TIMEOUT_MS,
+        "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        "compressors": MONGO_COMPRESSORS or None,
+    }
+    return {k: v for k, v in options.items() if v is not None}
+
+
+class PoolMonitor(ConnectionPoolListener):
+    """Connection pool listener counting connections and timing how long operations wait to check one out
+
+    Pool events are published from the Motor worker threads, a check out starts and ends on the same thread.
+    Counters are shared by those threads, so every update holds ``lock``.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.open = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def connection_check_out_started(self, event):
+        self.local.started = time.perf_counter()
+        with self.lock:
+            self.waiting += 1
+
+    def connection_checked_out(self, event):
+        wait = time.perf_counter() - getattr(self.local, "started", time.perf_counter())
+        with self.lock:
+            self.waiting -= 1
+            self.in_use += 1
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        observe_pool_wait(wait)
+
+    def connection_check_out_failed(self, event):
+        with self.lock:
+            self.waiting -= 1
+            self.checkout_failures += 1
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.in_use -= 1
+
+    def connection_created(self, event):
+        with self.lock:
+            self.open += 1
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.open -= 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "max_pool_size": MONGO_MAX_POOL_SIZE,
+                "min_pool_size": MONGO_MIN_POOL_SIZE,
+                "open": self.open,
+                "in_use": self.in_use,
+                "waiting": self.waiting,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "wait_avg": self.wait_total / self.checkouts if self.checkouts else 0.0,
+                "wait_max": self.wait_max
+            }
 
 
 class Database:
-    """Database abstraction Layer (Consider it as a Singleton)"""
-    client = None
-    engine = None
+    """Database abstraction Layer (Consider it as a Singleton)
+
+    Repositories reach their documents through ``storage``, on MongoDB or embedded in process.
+    """
+    client: Optional[AsyncIOMotorClient] = None
+    storage: Optional[Storage] = None
+    ready = False
+    pool_monitor = PoolMonitor()
     log_prefix = f"<> [{os.getpid()}] Server>> "
 
     @classmethod
     async def connect(cls):
-        """Opens connection to Database and instantiates the engine"""
-        logger.info(f"{cls.log_prefix}🔌 Connecting to MongoDB...")
-        cls.client = AsyncIOMotorClient(MONGO_URL)
-        cls.client.is_mongos
+        """Opens connection to Database and instantiates the storage"""
+        if STORAGE_BACKEND == "embedded":
+            logger.info(f"{cls.log_prefix}🔌 Opening embedded storage {EMBEDDED_STORAGE_PATH}...")
+            cls.storage = EmbeddedStorage(
+                EMBEDDED_STORAGE_PATH, MONGO_DATABASE, fsync=EMBEDDED_STORAGE_FSYNC, compact_ratio=EMBEDDED_STORAGE_COMPACT_RATIO
+            )
+            await asyncio.get_event_loop().run_in_executor(None, cls.storage.open)
+        else:
+            logger.info(f"{cls.log_prefix}🔌 Connecting to MongoDB...")
+            cls.client = AsyncIOMotorClient(MONGO_URL, event_listeners=[cls.pool_monitor], **client_options())
+            cls.client.is_mongos
+            cls.storage = MongoStorage(cls.client, MONGO_DATABASE)
         logger.info(f"{cls.log_prefix}✔️  Database connected.")
-        cls.init_db_engine()
     
     @classmethod
     async def disconnect(cls):
         """Closes connection to Database"""
         logger.info(f"{cls.log_prefix}🔌 Disconnecting from MongoDB...")
-        cls.client.close()
+        cls.ready = False
+        await cls.storage.close()
         logger.info(f"{cls.log_prefix}✔️  Database disconnected.")
-    
+
     @classmethod
-    def init_db_engine(cls):
-        """Initializes the engine"""
-        logger.info(f"{cls.log_prefix}⚙️  Initializing MongoDB Engine...")
-        cls.engine = AIOEngine(motor_client=cls.client, database=MONGO_DATABASE)
-        logger.info(f"{cls.log_prefix}✔️  Engine initialized.")
+    async def ping(cls, timeout: float = HEALTH_PING_TIMEOUT) -> bool:
+        """Checks that the server answers within the timeout"""
+        try:
+            await asyncio.wait_for(cls.storage.ping(), timeout)
+            return True
+        except Exception:
+            return False
+
+    @classmethod
+    async def warm_up(cls, models: List[Model]):
+        """Confirms connectivity, opens the minimum pool connections and loads collections and indexes
+
+        Every index is loaded by a count through it: the count is covered, it scans the index without fetching
+        a single document.
+
+        Args:
+            models (List[Model]): Models whose collections and indexes are loaded
+        """
+        logger.info(f"{cls.log_prefix}🔥 Warming up MongoDB connections...")
+        await cls.storage.ping()
+        await asyncio.gather(*[cls.storage.ping() for _ in range(MONGO_MIN_POOL_SIZE)])
+        for model in models:
+            collection = model.__collection__
+            for name in await cls.storage.index_information(collection):
+                await cls.storage.count(collection, {}, hint=name)
+        cls.ready = True
+        logger.info(f"{cls.log_prefix}✔️  MongoDB warmed up ({cls.pool_monitor.open} connections open).")
+
+    @classmethod
+    async def index_sizes(cls, model: Model) -> dict:
+        """Returns the size in bytes of every index of a model collection"""
+        return await cls.storage.index_sizes(model.__collection__)
+
+
+@lru_cache(maxsize=None)
+def view_projection(view: Type[NamedTuple]) -> Dict[str, int]:
+    """Projection fetching only the fields of a view, ``id`` being the document ``_id``"""
+    return {("_id" if field == "id" else field): 1 for field in view._fields}
+
+
+def build_view(view: Type[NamedTuple], doc: dict) -> NamedTuple:
+    """Builds a view straight from a projected document, skipping model validation"""
+    return view(*[doc.get("_id" if field == "id" else field) for field in view._fields])
+
+
+def _index_options(spec: dict) -> dict:
+    return {k: v for k, v in spec.items() if k not in ("v", "ns", "key", "name", "background")}
 
 
 class BaseRepository:
     """Object implementing the model repository in DB"""
     model: Model = None
+    indexes: List[IndexModel] = []
+    obsolete_indexes: List[str] = []
+    destroy_projection: dict = {"_id": 1}
     db = Database
 
-    async def partial_update(self, instance: Model, data: dict) -> Optional[Model]:
-        """Partially updates a resource
+    @property
+    def collection(self) -> str:
+        """Name of the collection backing the model"""
+        return self.model.__collection__
+
+    @property
+    def storage(self) -> Storage:
+        return self.db.storage
+
+    async def execute(self, operation: str, awaitable: Awaitable) -> Any:
+        """Awaits a DB call, timing it by operation and collection
+
+        Args:
+            operation (str): Operation name
+            awaitable (Awaitable): Storage call, not awaited yet
+
+        Returns:
+            Any: The call result
+        """
+        with observe_query(operation, self.collection), span(f"db.{operation}", collection=self.collection):
+            return await awaitable
+
+    async def ensure_indexes(self):
+        """Creates the declared indexes, rebuilding the ones whose definition changed
+
+        Obsolete indexes are dropped last, so the indexes replacing them are already built.
+        """
+        collection = self.collection
+        existing = await self.storage.index_information(collection)
+        for index in self.indexes:
+            spec = index.document
+            name = spec["name"]
+            current = existing.get(name)
+            if current:
+                if list(current["key"]) == list(spec["key"].items()) and _index_options(current) == _index_options(spec):
+                    logger.info(f"{self.db.log_prefix}✔️  Index {collection}.{name} up to date.")
+                    continue
+                logger.info(f"{self.db.log_prefix}🗑️  Dropping outdated index {collection}.{name}...")
+                await self.storage.drop_index(collection, name)
+            logger.info(f"{self.db.log_prefix}⚙️  Building index {collection}.{name}...")
+            await self.storage.create_index(collection, index)
+            logger.info(f"{self.db.log_prefix}✔️  Index {collection}.{name} built.")
+        for name in self.obsolete_indexes:
+            if name in existing:
+                logger.info(f"{self.db.log_prefix}🗑️  Dropping obsolete index {collection}.{name}...")
+                await self.storage.drop_index(collection, name)
+
+    def edited_values(self, data: dict) -> dict:
+        """Fields to ``$set`` for a partial update, empty values and the managed fields are left untouched"""
+        fields = set(self.model.__fields__) - {"id", "updated", "created"}
+        values = {field: value for field, value in data.items() if field in fields and value}
+        if "updated" in self.model.__fields__:
+            values["updated"] = datetime.datetime.utcnow()
+        return values
+
+    async def partial_update(self, id: str, data: dict) -> Optional[Model]:
+        """Partially updates a resource, setting only the edited fields in a single round trip
 
         Args:
-            instance (Model): Instance to update
+            id (str): Resource ID
             data (dict): Data
 
         Returns:
-            Optional[Model]: Modified model
+            Optional[Model]: Modified model, None if the resource does not exist
         """
-        fields = filter(lambda x: x not in ['id', 'updated', 'created'], self.model.__fields__.keys())
-        for field in fields:
-            if data.get(field, None):
-                setattr(instance, field, data[field])
-        if hasattr(instance, "updated"):
-            instance.updated = datetime.datetime.now()
-        return await self.db.engine.save(instance)
-
-    async def retrieve(self, id: str) -> Optional[Model]:
+        doc = await self.execute("find_one_and_update", self.storage.update_and_fetch(
+            self.collection, {"_id": ObjectId(id)}, {"$set": self.edited_values(data)}
+        ))
+        return self.model.parse_doc(doc) if doc else None
+
+    async def retrieve(self, id: str, view: Optional[Type[NamedTuple]] = None) -> Optional[Union[Model, NamedTuple]]:
         """Fetch a resource by its ID
 
         Args:
             id (str): Resource Object ID
+            view (Optional[Type[NamedTuple]], optional): Fetch only the fields of this view and return it. Defaults to None.
 
         Returns:
-            Optional[Model]: The retrieved instance
+            Optional[Union[Model, NamedTuple]]: The retrieved instance, or its view
         """
-        query = self.model.id == ObjectId(id)
-        return await self.db.engine.find_one(self.model, query)
+        if view:
+            return await self.find_view(view, {"_id": ObjectId(id)})
+        return await self.find_one({"_id": ObjectId(id)})
+
+    async def find_one(self, query: dict) -> Optional[Model]:
+        """Fetch the first resource matching a raw query"""
+        doc = await self.execute("find_one", self.storage.retrieve(self.collection, query))
+        return self.model.parse_doc(doc) if doc else None
+
+    async def find_many(self, query: dict) -> List[Model]:
+        """Fetch every resource matching a raw query"""
+        docs = await self.execute("find", self.storage.find(self.collection, query))
+        return [self.model.parse_doc(doc) for doc in docs]
+
+    async def find_view(self, view: Type[NamedTuple], query: dict) -> Optional[NamedTuple]:
+        """Fetch the view of the first resource matching a raw query"""
+        doc = await self.execute("find_one", self.storage.retrieve(self.collection, query, view_projection(view)))
+        return build_view(view, doc) if doc else None
     
     async def insert(self, data: dict) -> Optional[Model]:
-        """Creates or Updates an instance of a model
+        """Creates an instance of a model
 
         Args:
             data (dict): a dictionary describing the model fields and values
@@ -83,7 +318,19 @@ class BaseRepository:
             Optional[Model]: The created instance
         """
         inst = self.model(**data)
-        return await self.db.engine.save(inst)
+        await self.execute("insert_one", self.storage.insert(self.collection, inst.doc()))
+        return inst
+
+    async def insert_many(self, instances: List[Model]) -> Dict[int, dict]:
+        """Inserts many instances with a single unordered bulk write
+
+        Args:
+            instances (List[Model]): Instances to insert
+
+        Returns:
+            Dict[int, dict]: Write errors by position of the instance that failed, the others are inserted
+        """
+        return await self.execute("insert_many", self.storage.insert_many(self.collection, [inst.doc() for inst in instances]))
 
     async def retrieve_or_create(self, id: str, defaults: Optional[dict] = None) -> Optional[Model]:
         """Fetch a resource by its ID, if not found creates a new resource
@@ -109,18 +356,110 @@ class BaseRepository:
         Returns:
             Optional[Model]: The deleted resource
         """
-        inst = await self.retrieve(id=id)
-        if inst:
-            inst = await self.db.engine.delete(inst)
-        else:
+        doc = await self.execute("find_one_and_delete", self.storage.delete_and_fetch(self.collection, {"_id": ObjectId(id)}))
+        if not doc:
             raise Gone("Resource gone")
-        return inst
+        return self.model.parse_doc(doc)
+
+    async def destroy_many(self, ids: List[str]) -> List[dict]:
+        """Deletes many resources with a single ``delete_many``, after a single read of the existing ones
+
+        Args:
+            ids (List[str]): Resource IDs
+
+        Returns:
+            List[dict]: The deleted resources, with the fields of ``destroy_projection`` only
+        """
+        query = {"_id": {"$in": [ObjectId(id) for id in ids]}}
+        docs = await self.execute("find", self.storage.find(self.collection, query, self.destroy_projection))
+        if docs:
+            query = {"_id": {"$in": [doc["_id"] for doc in docs]}}
+            await self.execute("delete_many", self.storage.delete(self.collection, query, multi=True))
+        return docs
+
+    async def retrieve_many(self, ids: List[str], view: Optional[Type[NamedTuple]] = None) -> List[Union[Model, NamedTuple]]:
+        """Fetches many resources by ID with a single ``$in`` query, the missing ones are left out
+
+        Args:
+            ids (List[str]): Resource IDs
+            view (Optional[Type[NamedTuple]], optional): Fetch only the fields of this view. Defaults to None.
+
+        Returns:
+            List[Union[Model, NamedTuple]]: The retrieved instances, or their views
+        """
+        query = {"_id": {"$in": [ObjectId(id) for id in ids]}}
+        docs = await self.execute("find", self.storage.find(self.collection, query, view_projection(view) if view else None))
+        return [build_view(view, doc) if view else self.model.parse_doc(doc) for doc in docs]
+
+    async def bulk_partial_update(self, updates: List[Tuple[str, dict]]) -> Dict[int, dict]:
+        """Partially updates many resources with a single unordered bulk write
+
+        Args:
+            updates (List[Tuple[str, dict]]): Resource ID and data of every update, empty values are left untouched
+
+        Returns:
+            Dict[int, dict]: Write errors by position of the update that failed, the others are applied
+        """
+        operations = [({"_id": ObjectId(id)}, {"$set": self.edited_values(data)}) for id, data in updates]
+        if not operations:
+            return {}
+        return await self.execute("bulk_write", self.storage.bulk_update(self.collection, operations))
     
-    async def list(self, *filters):
+    async def list(self, *filters, view: Optional[Type[NamedTuple]] = None):
         """Returns a collection of resources
         Args:
             *filters (tuple): A list of ODMantic compatible filters
+            view (Optional[Type[NamedTuple]], optional): Fetch only the fields of this view. Defaults to None.
         Returns:
-            List[Model]: Result of the query
+            List[Union[Model, NamedTuple]]: Result of the query
+        """
+        query = and_(*filters) if filters else {}
+        docs = await self.execute("find", self.storage.find(self.collection, query, view_projection(view) if view else None))
+        return [build_view(view, doc) if view else self.model.parse_doc(doc) for doc in docs]
+
+    async def paginate(self, *filters, limit: int, after: Optional[str] = None,
+                       view: Optional[Type[NamedTuple]] = None) -> Tuple[List[Union[Model, NamedTuple]], Optional[str]]:
+        """Returns a page of resources ordered by ID (keyset pagination)
+
+        Args:
+            *filters (tuple): A list of ODMantic compatible filters
+            limit (int): Maximum page size
+            after (Optional[str], optional): ID of the last resource of the previous page. Defaults to None.
+            view (Optional[Type[NamedTuple]], optional): Fetch only the fields of this view. Defaults to None.
+
+        Raises:
+            BadRequest: when the cursor is not a valid ID
+
+        Returns:
+            Tuple[List[Union[Model, NamedTuple]], Optional[str]]: The page and the cursor of the next one, if any
+        """
+        if after:
+            if not ObjectId.is_valid(after):
+                raise BadRequest("Invalid cursor")
+            filters = (*filters, self.model.id > ObjectId(after))
+        query = and_(*filters) if filters else {}
+        docs = await self.execute("find", self.storage.find(
+            self.collection, query, view_projection(view) if view else None, sort=[("_id", ASCENDING)], limit=limit + 1
+        ))
+        collection = [build_view(view, doc) if view else self.model.parse_doc(doc) for doc in docs]
+        next_cursor = str(collection[limit - 1].id) if len(collection) > limit else None
+        return collection[:limit], next_cursor
+
+    async def iterate(self, *filters, batch_size: int = STREAM_BATCH_SIZE,
+                      view: Optional[Type[NamedTuple]] = None) -> AsyncIterator[Union[Model, NamedTuple]]:
+        """Iterates over resources ordered by ID, fetching them from the DB in batches
+
+        Args:
+            *filters (tuple): A list of ODMantic compatible filters
+            batch_size (int, optional): Documents fetched per round trip. Defaults to STREAM_BATCH_SIZE.
+            view (Optional[Type[NamedTuple]], optional): Fetch only the fields of this view. Defaults to None.
+
+        Yields:
+            Union[Model, NamedTuple]: The resources, or their views
         """
-        return await self.db.engine.find(self.model, *filters)
+        query = and_(*filters) if filters else {}
+        docs = self.storage.iterate(
+            self.collection, query, view_projection(view) if view else None, sort=[("_id", ASCENDING)], batch_size=batch_size
+        )
+        async for doc in docs:
+            yield build_view(view, doc) if view else self.model.parse_doc(doc)
@@ -0,0 +1,737 @@
+"""Embedded in-process storage backend
+
+Implements the ``Storage`` interface of the repositories in a single process. Collections live in memory with hash
+indexes on the first field of every declared index; queries and updates are evaluated for the operators listed in
+``storage.QUERY_OPERATORS`` and ``storage.UPDATE_OPERATORS``, any other operator raises ``OperationFailure``.
+Every write is appended to a BSON log, replayed at startup and compacted into a snapshot off the event loop.
+"""
+import os
+import fcntl
+import bisect
+import asyncio
+import datetime
+import operator
+from functools import lru_cache
+from itertools import islice
+from typing import Any, AsyncIterator, Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+import bson
+from bson import ObjectId
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from loguru import logger
+from pymongo import IndexModel
+from pymongo.errors import DuplicateKeyError, OperationFailure, WriteError
+from .storage import Storage, Sort
+
+
+MEMORY = ":memory:"
+RAW_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+
+# Documents
+
+@lru_cache(maxsize=1024)
+def _parts(path: str) -> Tuple[str, ...]:
+    return tuple(path.split("."))
+
+
+def _get(doc: dict, path: str) -> Tuple[bool, Any]:
+    """Returns whether a dotted path exists in the document and its value"""
+    value = doc
+    for part in _parts(path):
+        if not isinstance(value, dict) or part not in value:
+            return False, None
+        value = value[part]
+    return True, value
+
+
+def _set(doc: dict, path: str, value: Any):
+    *parents, last = _parts(path)
+    for part in parents:
+        child = doc.setdefault(part, {})
+        if not isinstance(child, dict):
+            raise WriteError(f"Cannot create field '{last}' in element {{{part}: {child!r}}}", code=28)
+        doc = child
+    doc[last] = value
+
+
+def _unset(doc: dict, path: str):
+    *parents, last = _parts(path)
+    for part in parents:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(last, None)
+
+
+def _rank(value: Any) -> int:
+    """BSON comparison order of the value type, values of different types never match range operators"""
+    if value is None:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, (list, tuple)):
+        return 5
+    if isinstance(value, bytes):
+        return 6
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime.datetime):
+        return 9
+    return 10
+
+
+def _sort_key(value: Any) -> Tuple[int, Any]:
+    rank = _rank(value)
+    return (rank, repr(value)) if rank in (4, 5, 10) else (rank, value)
+
+
+def _hashable(value: Any) -> Hashable:
+    if isinstance(value, dict):
+        return tuple((k, _hashable(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    return value
+
+
+# Queries
+
+def _eq(found: bool, value: Any, arg: Any) -> bool:
+    if arg is None:
+        return not found or value is None
+    return found and _rank(value) == _rank(arg) and value == arg
+
+
+def _compare(op: Callable[[Any, Any], bool]) -> Callable[[bool, Any, Any], bool]:
+    def compare(found: bool, value: Any, arg: Any) -> bool:
+        return found and _rank(value) == _rank(arg) and op(_sort_key(value), _sort_key(arg))
+    return compare
+
+
+OPERATORS: Dict[str, Callable[[bool, Any, Any], bool]] = {
+    "$eq": _eq,
+    "$ne": lambda found, value, arg: not _eq(found, value, arg),
+    "$gt": _compare(operator.gt),
+    "$gte": _compare(operator.ge),
+    "$lt": _compare(operator.lt),
+    "$lte": _compare(operator.le),
+    "$in": lambda found, value, arg: any(_eq(found, value, v) for v in arg),
+    "$exists": lambda found, value, arg: found == bool(arg),
+}
+
+
+def _is_operator_doc(cond: Any) -> bool:
+    return isinstance(cond, dict) and bool(cond) and all(k.startswith("$") for k in cond)
+
+
+def match(doc: dict, query: dict) -> bool:
+    """Evaluates a query filter against a document"""
+    for field, cond in query.items():
+        if field == "$and":
+            if not all(match(doc, q) for q in cond):
+                return False
+        elif field == "$or":
+            if not any(match(doc, q) for q in cond):
+                return False
+        elif field.startswith("$"):
+            raise OperationFailure(f"Unsupported query operator: {field}", code=2)
+        else:
+            found, value = _get(doc, field)
+            if _is_operator_doc(cond):
+                for op, arg in cond.items():
+                    if op not in OPERATORS:
+                        raise OperationFailure(f"Unsupported query operator: {op}", code=2)
+                    if not OPERATORS[op](found, value, arg):
+                        return False
+            elif not _eq(found, value, cond):
+                return False
+    return True
+
+
+def _equalities(query: dict) -> Iterable[Tuple[str, Any]]:
+    """Top level equality conditions of a query, used to seed upserted documents"""
+    for field, cond in query.items():
+        if field == "$and":
+            for q in cond:
+                yield from _equalities(q)
+        elif not field.startswith("$"):
+            if _is_operator_doc(cond):
+                if "$eq" in cond:
+                    yield field, cond["$eq"]
+            else:
+                yield field, cond
+
+
+def _lookup_values(cond: Any) -> Optional[List[Any]]:
+    """Values a field must equal to match the condition, None when it is not an equality"""
+    if _is_operator_doc(cond):
+        if "$eq" in cond:
+            return [cond["$eq"]]
+        if "$in" in cond:
+            return list(cond["$in"])
+        return None
+    return [cond]
+
+
+def apply_update(doc: dict, update: dict, inserting: bool = False) -> dict:
+    """Applies update operators to a copy owned by the caller"""
+    for op, fields in update.items():
+        if op == "$set":
+            for path, value in fields.items():
+                _set(doc, path, value)
+        elif op == "$setOnInsert":
+            if inserting:
+                for path, value in fields.items():
+                    _set(doc, path, value)
+        elif op == "$unset":
+            for path in fields:
+                _unset(doc, path)
+        elif op == "$inc":
+            for path, amount in fields.items():
+                found, value = _get(doc, path)
+                if found and _rank(value) != 2:
+                    raise WriteError(f"Cannot apply $inc to a value of non-numeric type {type(value).__name__}", code=14)
+                _set(doc, path, (value if found else 0) + amount)
+        else:
+            raise OperationFailure(f"Unsupported update operator: {op}", code=9)
+    return doc
+
+
+def project(doc: dict, projection: Optional[dict]) -> dict:
+    if not projection:
+        return doc
+    included = [field for field, flag in projection.items() if flag and field != "_id"]
+    if not included:
+        for field, flag in projection.items():
+            if not flag:
+                _unset(doc, field)
+        return doc
+    out = {"_id": doc["_id"]} if projection.get("_id", 1) and "_id" in doc else {}
+    for field in included:
+        found, value = _get(doc, field)
+        if found:
+            _set(out, field, value)
+    return out
+
+
+# Indexes
+
+class EmbeddedIndex:
+    """Hash index on the first key of an index, with uniqueness enforced on the whole key"""
+
+    def __init__(self, spec: dict):
+        self.spec = spec
+        self.name = spec["name"]
+        self.fields = list(spec["key"].keys())
+        self.unique = bool(spec.get("unique"))
+        self.sparse = bool(spec.get("sparse"))
+        self.partial = spec.get("partialFilterExpression")
+        self.entries: Dict[Hashable, Set[Hashable]] = {}
+        self.unique_entries: Dict[Hashable, Hashable] = {}
+
+    @property
+    def usable(self) -> bool:
+        return self.partial is None
+
+    def covers(self, doc: dict) -> bool:
+        if self.partial is not None and not match(doc, self.partial):
+            return False
+        return not self.sparse or any(_get(doc, field)[0] for field in self.fields)
+
+    def keys(self, doc: dict) -> Tuple[Hashable, Hashable]:
+        values = tuple(_hashable(_get(doc, field)[1]) for field in self.fields)
+        return values[0], values
+
+    def conflict(self, doc: dict, key: Hashable) -> Optional[Hashable]:
+        if not self.unique or not self.covers(doc):
+            return None
+        owner = self.unique_entries.get(self.keys(doc)[1])
+        return owner if owner is not None and owner != key else None
+
+    def add(self, doc: dict, key: Hashable):
+        if not self.covers(doc):
+            return
+        first, values = self.keys(doc)
+        self.entries.setdefault(first, set()).add(key)
+        if self.unique:
+            self.unique_entries[values] = key
+
+    def remove(self, doc: dict, key: Hashable):
+        if not self.covers(doc):
+            return
+        first, values = self.keys(doc)
+        bucket = self.entries.get(first)
+        if bucket is not None:
+            bucket.discard(key)
+            if not bucket:
+                del self.entries[first]
+        if self.unique and self.unique_entries.get(values) == key:
+            del self.unique_entries[values]
+
+    def lookup(self, values: List[Any]) -> Optional[Set[Hashable]]:
+        if self.sparse and None in values:
+            return None
+        ids: Set[Hashable] = set()
+        for value in values:
+            ids.update(self.entries.get(_hashable(value), ()))
+        return ids
+
+    def size(self) -> int:
+        """Approximate size in bytes, comparable with MongoDB ``indexSizes``"""
+        return sum(len(bson.encode({"k": value})) + 16 * len(ids) for value, ids in self.entries.items())
+
+    def information(self) -> dict:
+        return {"v": 2, **{k: v for k, v in self.spec.items() if k != "name"}, "key": list(self.spec["key"].items())}
+
+
+# Collections
+
+class EmbeddedCollection:
+    """In memory collection, every write is applied atomically within the event loop"""
+
+    def __init__(self, storage: "EmbeddedStorage", full_name: str):
+        self.storage = storage
+        self.full_name = full_name
+        self.docs: Dict[Hashable, dict] = {}
+        self.raw: Dict[Hashable, bytes] = {}
+        self.order: List[Tuple[int, Any]] = []
+        self.indexes: Dict[str, EmbeddedIndex] = {}
+
+    # Reads
+
+    def read(self, key: Hashable, projection: Optional[dict] = None) -> dict:
+        """Returns a private copy of a document"""
+        return project(bson.decode(self.raw[key]), projection)
+
+    def _candidates(self, query: dict) -> Optional[Set[Hashable]]:
+        """Keys of the documents that may match, through ``_id`` or the indexes; None means a full scan"""
+        best: Optional[Set[Hashable]] = None
+        for field, cond in query.items():
+            ids = None
+            if field == "$or":
+                branches = [self._candidates(q) for q in cond]
+                if all(branch is not None for branch in branches):
+                    ids = set().union(*branches)
+            elif field == "$and":
+                for q in cond:
+                    branch = self._candidates(q)
+                    if branch is not None and (ids is None or len(branch) < len(ids)):
+                        ids = branch
+            elif not field.startswith("$"):
+                values = _lookup_values(cond)
+                if values is None:
+                    continue
+                if field == "_id":
+                    ids = {_hashable(v) for v in values if _hashable(v) in self.docs}
+                else:
+                    for index in self.indexes.values():
+                        if index.usable and index.fields[0] == field:
+                            ids = index.lookup(values)
+                            if ids is not None:
+                                break
+            if ids is not None and (best is None or len(ids) < len(best)):
+                best = ids
+        return best
+
+    def _id_range(self, query: dict) -> int:
+        """Position in the ``_id`` order of the first document a lower bound on ``_id`` can match"""
+        cond = query.get("_id")
+        if _is_operator_doc(cond):
+            if "$gt" in cond:
+                return bisect.bisect_right(self.order, _sort_key(cond["$gt"]))
+            if "$gte" in cond:
+                return bisect.bisect_left(self.order, _sort_key(cond["$gte"]))
+        for q in query.get("$and", ()):
+            start = self._id_range(q)
+            if start:
+                return start
+        return 0
+
+    def select(self, query: dict, sort: Optional[Sort] = None, limit: int = 0) -> List[Hashable]:
+        """Keys of the matching documents in order, with the limit applied"""
+        candidates = self._candidates(query)
+        if candidates is None and sort and len(sort) == 1 and sort[0][0] == "_id":
+            # Walks the _id order, stopping as soon as the page is full
+            ordered = islice(self.order, self._id_range(query), None) if sort[0][1] > 0 else reversed(self.order)
+            keys = []
+            for _, key in ordered:
+                if match(self.docs[key], query):
+                    keys.append(key)
+                    if limit and len(keys) >= limit:
+                        break
+            return keys
+        source = self.docs.keys() if candidates is None else [k for k in candidates if k in self.docs]
+        keys = [key for key in source if match(self.docs[key], query)]
+        if sort:
+            for field, direction in reversed(sort):
+                keys.sort(key=lambda k: _sort_key(_get(self.docs[k], field)[1]), reverse=direction < 0)
+        elif candidates is not None:
+            keys.sort(key=lambda k: _sort_key(k))
+        return keys[:limit] if limit else keys
+
+    def first(self, query: dict) -> Optional[Hashable]:
+        keys = self.select(query, limit=1)
+        return keys[0] if keys else None
+
+    # Writes
+
+    def put(self, doc: dict, key: Optional[Hashable] = None) -> dict:
+        """Stores a document, replacing the one at ``key``; raises DuplicateKeyError leaving the collection untouched"""
+        if "_id" not in doc:
+            doc = {"_id": ObjectId(), **doc}
+        elif next(iter(doc)) != "_id":
+            doc = {"_id": doc["_id"], **doc}
+        raw = bson.encode(doc)
+        doc = bson.decode(raw)
+        new_key = _hashable(doc["_id"])
+        if key is not None and new_key != key:
+            raise WriteError("Performing an update on the path '_id' would modify the immutable field '_id'", code=66)
+        if key is None and new_key in self.docs:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.full_name} index: _id_", 11000,
+                                    {"code": 11000, "keyValue": {"_id": doc["_id"]}})
+        for index in self.indexes.values():
+            if index.conflict(doc, new_key) is not None:
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.full_name} index: {index.name}", 11000, {
+                    "code": 11000, "keyPattern": index.spec["key"],
+                    "keyValue": {field: _get(doc, field)[1] for field in index.fields}
+                })
+        self.store(new_key, doc, raw)
+        self.storage.log({"c": self.full_name, "put": RawBSONDocument(raw)})
+        return doc
+
+    def store(self, key: Hashable, doc: dict, raw: bytes):
+        old = self.docs.get(key)
+        if old is None:
+            bisect.insort(self.order, (_sort_key(key)[0], key))
+        else:
+            for index in self.indexes.values():
+                index.remove(old, key)
+        self.docs[key] = doc
+        self.raw[key] = raw
+        for index in self.indexes.values():
+            index.add(doc, key)
+
+    def forget(self, key: Hashable):
+        doc = self.docs.pop(key)
+        del self.raw[key]
+        position = bisect.bisect_left(self.order, (_sort_key(key)[0], key))
+        del self.order[position]
+        for index in self.indexes.values():
+            index.remove(doc, key)
+        return doc
+
+    def delete(self, key: Hashable):
+        doc = self.forget(key)
+        self.storage.log({"c": self.full_name, "del": doc["_id"]})
+
+    def update(self, key: Hashable, update: dict) -> Tuple[dict, dict]:
+        before = bson.decode(self.raw[key])
+        after = apply_update(bson.decode(self.raw[key]), update)
+        if after != before:
+            after = self.put(after, key)
+        return before, after
+
+    def upsert(self, query: dict, update: dict) -> dict:
+        doc = {}
+        for field, value in _equalities(query):
+            _set(doc, field, value)
+        return self.put(apply_update(doc, update, inserting=True))
+
+    # Indexes
+
+    def create_index(self, spec: dict, logged: bool = True) -> str:
+        spec = {**spec, "key": dict(spec["key"])}
+        index = EmbeddedIndex(spec)
+        for key, doc in self.docs.items():
+            if index.conflict(doc, key) is not None:
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.full_name} index: {index.name}", 11000)
+            index.add(doc, key)
+        self.indexes[index.name] = index
+        if logged:
+            self.storage.log({"c": self.full_name, "index": spec})
+        return index.name
+
+    def drop_index(self, name: str, logged: bool = True):
+        if name not in self.indexes:
+            raise OperationFailure(f"index not found with name [{name}]", code=27)
+        del self.indexes[name]
+        if logged:
+            self.storage.log({"c": self.full_name, "drop_index": name})
+
+
+# Persistence
+
+def write_snapshot(path: str, snapshot: List[Tuple[str, List[dict], List[bytes]]]) -> int:
+    """Writes the index specs and raw documents of every collection as a log, returning its number of records"""
+    records = 0
+    with open(path, "wb") as file:
+        for full_name, specs, raws in snapshot:
+            for spec in specs:
+                file.write(bson.encode({"c": full_name, "index": spec}))
+            for raw in raws:
+                file.write(bson.encode({"c": full_name, "put": RawBSONDocument(raw)}))
+            records += len(specs) + len(raws)
+        file.flush()
+        os.fsync(file.fileno())
+    return records
+
+
+# Storage
+
+class EmbeddedStorage(Storage):
+    """In process storage of a database, persisted in an append-only BSON log
+
+    The log is locked for the lifetime of the storage: a single process at a time owns the data. When the log
+    grows past ``compact_ratio`` times the live records, a snapshot is written by a worker thread; the records
+    logged meanwhile are appended to it before it replaces the log.
+    """
+
+    def __init__(self, path: str = MEMORY, database: str = "lemonsso", fsync: bool = False, compact_ratio: float = 4):
+        self.path = path
+        self.database = database
+        self.fsync = fsync
+        self.compact_ratio = compact_ratio
+        self.collections: Dict[str, EmbeddedCollection] = {}
+        self.records = 0
+        self.compaction: Optional[asyncio.Future] = None
+        self._tail: Optional[List[bytes]] = None
+        self._file = None
+        self._lock = None
+
+    @property
+    def persistent(self) -> bool:
+        return self.path != MEMORY
+
+    def collection(self, name: str) -> EmbeddedCollection:
+        full_name = f"{self.database}.{name}"
+        if full_name not in self.collections:
+            self.collections[full_name] = EmbeddedCollection(self, full_name)
+        return self.collections[full_name]
+
+    # Persistence
+
+    def open(self):
+        """Locks and replays the log, blocking: run it before serving or in an executor"""
+        if not self.persistent:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._lock = open(f"{self.path}.lock", "w")
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock.close()
+            self._lock = None
+            raise RuntimeError(f"Embedded storage {self.path} is in use by another process")
+        self.load()
+        if self.records > self.compact_ratio * max(self.live(), 1000):
+            self.records = write_snapshot(f"{self.path}.compact", self.snapshot())
+            os.replace(f"{self.path}.compact", self.path)
+        self._file = open(self.path, "ab")
+
+    def load(self):
+        """Replays the log, truncating a partially written trailing record"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r+b") as file:
+            data = file.read()
+            offset = 0
+            while offset + 4 <= len(data):
+                size = int.from_bytes(data[offset:offset + 4], "little")
+                if size < 5 or offset + size > len(data):
+                    break
+                self.replay(bson.decode(data[offset:offset + size], codec_options=RAW_OPTIONS))
+                offset += size
+                self.records += 1
+            if offset < len(data):
+                logger.warning(f"Embedded storage: dropping {len(data) - offset} bytes of truncated log")
+                file.truncate(offset)
+        logger.info(f"Embedded storage: {self.live()} documents loaded from {self.path}")
+
+    def replay(self, record: RawBSONDocument):
+        full_name = record["c"]
+        if full_name not in self.collections:
+            self.collections[full_name] = EmbeddedCollection(self, full_name)
+        collection = self.collections[full_name]
+        if "put" in record:
+            raw = record["put"].raw
+            doc = bson.decode(raw)
+            collection.store(_hashable(doc["_id"]), doc, raw)
+        elif "del" in record:
+            key = _hashable(record["del"])
+            if key in collection.docs:
+                collection.forget(key)
+        elif "index" in record:
+            collection.create_index(bson.decode(record["index"].raw), logged=False)
+        elif "drop_index" in record:
+            collection.indexes.pop(record["drop_index"], None)
+
+    def log(self, record: dict):
+        if self._file is None:
+            return
+        data = bson.encode(record)
+        self._file.write(data)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.records += 1
+        if self._tail is not None:
+            self._tail.append(data)
+        elif self.records > self.compact_ratio * max(self.live(), 1000):
+            self._tail = []
+            self.compaction = asyncio.ensure_future(self.compact(self.snapshot()))
+
+    def live(self) -> int:
+        return sum(len(c.docs) + len(c.indexes) for c in self.collections.values())
+
+    def snapshot(self) -> List[Tuple[str, List[dict], List[bytes]]]:
+        """Index specs and raw documents of every collection, cheap to take since raw documents are immutable"""
+        return [
+            (c.full_name, [index.spec for index in c.indexes.values()], list(c.raw.values()))
+            for c in self.collections.values()
+        ]
+
+    async def compact(self, snapshot: List[Tuple[str, List[dict], List[bytes]]]):
+        """Rewrites the log as a snapshot written in a worker thread, then appends the records logged meanwhile"""
+        tmp = f"{self.path}.compact"
+        try:
+            records = await asyncio.get_event_loop().run_in_executor(None, write_snapshot, tmp, snapshot)
+            with open(tmp, "ab") as file:
+                file.write(b"".join(self._tail))
+            self._file.close()
+            os.replace(tmp, self.path)
+            self._file = open(self.path, "ab")
+            self.records = records + len(self._tail)
+        except OSError:
+            logger.exception("Embedded storage: log compaction failed")
+        finally:
+            self._tail = None
+
+    async def close(self):
+        if self.compaction is not None:
+            await self.compaction
+            self.compaction = None
+        if self._file is not None:
+            self._tail = []
+            await self.compact(self.snapshot())
+            self._file.close()
+            self._file = None
+        if self._lock is not None:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+            self._lock.close()
+            self._lock = None
+
+    # Storage interface
+
+    async def retrieve(self, collection: str, query: dict, projection: Optional[dict] = None) -> Optional[dict]:
+        store = self.collection(collection)
+        key = store.first(query)
+        return None if key is None else store.read(key, projection)
+
+    async def find(self, collection: str, query: dict, projection: Optional[dict] = None, sort: Optional[Sort] = None,
+                   limit: int = 0, hint: Optional[str] = None) -> List[dict]:
+        store = self.collection(collection)
+        return [store.read(key, projection) for key in store.select(query, sort, limit)]
+
+    async def iterate(self, collection: str, query: dict, projection: Optional[dict] = None, sort: Optional[Sort] = None,
+                      batch_size: int = 1000) -> AsyncIterator[dict]:
+        store = self.collection(collection)
+        keys = store.select(query, sort)
+        for start in range(0, len(keys), batch_size):
+            for key in keys[start:start + batch_size]:
+                if key in store.raw:
+                    yield store.read(key, projection)
+            await asyncio.sleep(0)
+
+    async def count(self, collection: str, query: dict, hint: Optional[str] = None) -> int:
+        return len(self.collection(collection).select(query))
+
+    async def group_count(self, collection: str, field: str, start: int, length: int) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for doc in self.collection(collection).docs.values():
+            value = _get(doc, field)[1]
+            group = value[start:start + length] if isinstance(value, str) else ""
+            counts[group] = counts.get(group, 0) + 1
+        return counts
+
+    async def insert(self, collection: str, doc: dict):
+        doc.setdefault("_id", self.collection(collection).put(doc)["_id"])
+
+    async def insert_many(self, collection: str, docs: List[dict]) -> Dict[int, dict]:
+        store = self.collection(collection)
+        errors = {}
+        for position, doc in enumerate(docs):
+            try:
+                doc.setdefault("_id", store.put(doc)["_id"])
+            except (DuplicateKeyError, WriteError) as e:
+                errors[position] = {"index": position, "code": e.code, "errmsg": str(e)}
+        return errors
+
+    async def update(self, collection: str, query: dict, update: dict, multi: bool = False,
+                     upsert: bool = False) -> Tuple[int, int]:
+        store = self.collection(collection)
+        keys = store.select(query, limit=0 if multi else 1)
+        if not keys and upsert:
+            store.upsert(query, update)
+            return 0, 0
+        modified = 0
+        for key in keys:
+            before, after = store.update(key, update)
+            modified += before != after
+        return len(keys), modified
+
+    async def update_and_fetch(self, collection: str, query: dict, update: dict, projection: Optional[dict] = None,
+                               upsert: bool = False, before: bool = False) -> Optional[dict]:
+        store = self.collection(collection)
+        key = store.first(query)
+        if key is None:
+            inserted = store.upsert(query, update) if upsert else None
+            return project(inserted, projection) if inserted and not before else None
+        return project(store.update(key, update)[0 if before else 1], projection)
+
+    async def bulk_update(self, collection: str, updates: List[Tuple[dict, dict]]) -> Dict[int, dict]:
+        errors = {}
+        for position, (query, update) in enumerate(updates):
+            try:
+                await self.update(collection, query, update)
+            except (DuplicateKeyError, WriteError) as e:
+                errors[position] = {"index": position, "code": e.code, "errmsg": str(e)}
+        return errors
+
+    async def delete(self, collection: str, query: dict, multi: bool = False) -> int:
+        store = self.collection(collection)
+        keys = store.select(query, limit=0 if multi else 1)
+        for key in keys:
+            store.delete(key)
+        return len(keys)
+
+    async def delete_and_fetch(self, collection: str, query: dict, projection: Optional[dict] = None) -> Optional[dict]:
+        store = self.collection(collection)
+        key = store.first(query)
+        if key is None:
+            return None
+        doc = store.read(key, projection)
+        store.delete(key)
+        return doc
+
+    async def index_information(self, collection: str) -> Dict[str, dict]:
+        indexes = self.collection(collection).indexes
+        return {"_id_": {"v": 2, "key": [("_id", 1)]}, **{name: index.information() for name, index in indexes.items()}}
+
+    async def create_index(self, collection: str, index: IndexModel):
+        self.collection(collection).create_index(index.document)
+
+    async def drop_index(self, collection: str, name: str):
+        self.collection(collection).drop_index(name)
+
+    async def index_sizes(self, collection: str) -> Dict[str, int]:
+        store = self.collection(collection)
+        return {"_id_": 28 * len(store.docs), **{name: index.size() for name, index in store.indexes.items()}}
+
+    async def ping(self):
+        pass
@@ -0,0 +1,103 @@
+import csv
+import asyncio
+from typing import AsyncIterator, Iterable, Iterator, List, Tuple
+import orjson
+from loguru import logger
+from pydantic import ValidationError
+from .config import IMPORT_BATCH_SIZE, IMPORT_HASH_WORKERS
+from .database import Database
+from .models import User, NotUnique, user_repo, DUPLICATE_KEY_ERROR
+from .serializers import WriteUser
+from .utils.exceptions import WebException, NotValid, CantPerform, ServiceUnavailable
+from .utils.passwords import PasswordPool, _hash
+
+
+def parse_rows(lines: Iterable[str], fmt: str) -> Iterator[Tuple[int, dict]]:
+    """Parses CSV (with header) or NDJSON lines lazily, yielding (row number, row)"""
+    if fmt == "csv":
+        for number, row in enumerate(csv.DictReader(lines), start=1):
+            yield number, row
+        return
+    for number, line in enumerate(lines, start=1):
+        if line.strip():
+            try:
+                yield number, orjson.loads(line)
+            except orjson.JSONDecodeError as e:
+                yield number, {"__error__": str(e)}
+
+
+def row_result(number: int, username: str, exc: WebException = None) -> dict:
+    return {
+        "row": number,
+        "username": username,
+        "operation": exc is None,
+        "code": exc.exc_code if exc else "OK",
+        "reason": exc.reason if exc else None
+    }
+
+
+async def hash_row(limit: asyncio.Semaphore, password: str) -> str:
+    """Hashes on the password pool, waiting instead of failing while sign ins saturate it"""
+    async with limit:
+        while True:
+            try:
+                return await PasswordPool.run(_hash, password.encode("utf-8"))
+            except ServiceUnavailable:
+                await asyncio.sleep(PasswordPool.expected_latency(_hash) or 0.1)
+
+
+async def import_batch(limit: asyncio.Semaphore, batch: List[Tuple[int, WriteUser]]) -> List[dict]:
+    hashes = await asyncio.gather(*[hash_row(limit, user.password.get_secret_value()) for _, user in batch])
+    errors = await user_repo.insert_many([
+        User(username=user.username, password=pwd) for (_, user), pwd in zip(batch, hashes)
+    ])
+    results = []
+    for position, (number, user) in enumerate(batch):
+        error = errors.get(position)
+        if error is None:
+            results.append(row_result(number, user.username))
+        elif error.get("code") == DUPLICATE_KEY_ERROR:
+            results.append(row_result(number, user.username, NotUnique("Username is not unique")))
+        else:
+            results.append(row_result(number, user.username, CantPerform(error.get("errmsg"))))
+    return results
+
+
+async def import_users(lines: Iterable[str], fmt: str = "ndjson", batch_size: int = IMPORT_BATCH_SIZE) -> AsyncIterator[dict]:
+    """Imports users from a stream of CSV or NDJSON lines, with constant memory usage
+
+    Rows are validated as ``WriteUser``, passwords are hashed on the password pool, at most
+    ``IMPORT_HASH_WORKERS`` at a time so sign ins keep their share, and every batch is written
+    with one unordered ``insert_many``, so conflicts never abort the import.
+
+    Args:
+        lines (Iterable[str]): CSV (with ``username,password`` header) or NDJSON lines
+        fmt (str, optional): ``csv`` or ``ndjson``. Defaults to "ndjson".
+        batch_size (int, optional): Rows hashed and inserted together. Defaults to IMPORT_BATCH_SIZE.
+
+    Yields:
+        dict: The outcome of every row, invalid rows are reported as soon as they are parsed
+    """
+    imported = failed = 0
+    limit = asyncio.Semaphore(IMPORT_HASH_WORKERS)
+    batch = []
+    for number, row in parse_rows(lines, fmt):
+        try:
+            if "__error__" in row:
+                raise ValueError(row["__error__"])
+            batch.append((number, WriteUser(**row)))
+        except (ValidationError, ValueError, TypeError) as e:
+            failed += 1
+            yield row_result(number, row.get("username") if isinstance(row, dict) else None, NotValid(str(e)))
+        if len(batch) >= batch_size:
+            for result in await import_batch(limit, batch):
+                imported += result["operation"]
+                failed += not result["operation"]
+                yield result
+            batch = []
+    if batch:
+        for result in await import_batch(limit, batch):
+            imported += result["operation"]
+            failed += not result["operation"]
+            yield result
+    logger.info(f"{Database.log_prefix}📥 Users import done: {imported} imported, {failed} failed.")
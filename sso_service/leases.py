@@ -0,0 +1,56 @@
+import os
+import socket
+import secrets
+import datetime
+from loguru import logger
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from .database import Database
+
+OWNER = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+
+
+class Lease:
+    """Expiring lock document electing the single worker of the deployment that runs a background job
+
+    The holder renews the lease every time it runs the job; when it dies the lease expires and the next worker
+    trying to acquire it takes it over.
+    """
+    collection_name = "leases"
+
+    def __init__(self, name: str, ttl: float):
+        self.name = name
+        self.ttl = ttl
+        self.held = False
+
+    async def acquire(self) -> bool:
+        """Takes or renews the lease, False while another worker holds it
+
+        Returns:
+            bool: Whether this worker holds the lease for the next ``ttl`` seconds
+        """
+        now = datetime.datetime.utcnow()
+        try:
+            await Database.storage.update(
+                self.collection_name,
+                {"_id": self.name, "$or": [{"owner": OWNER}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": OWNER, "expires_at": now + datetime.timedelta(seconds=self.ttl)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            held = False
+        else:
+            held = True
+        if held != self.held:
+            logger.info(f"{Database.log_prefix}🔒 Lease {self.name} {'acquired' if held else 'lost'}.")
+        self.held = held
+        return held
+
+    async def release(self):
+        """Gives the lease back, so another worker can take it over without waiting for its expiry"""
+        if not self.held:
+            return
+        self.held = False
+        try:
+            await Database.storage.delete(self.collection_name, {"_id": self.name, "owner": OWNER})
+        except PyMongoError:
+            logger.exception(f"{Database.log_prefix}❌ Lease {self.name} release failed.")
@@ -1,10 +1,21 @@
 import fastapi
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from .database import Database
-from .config import APP_VERSION, DEBUG
+from .models import token_cache
+from .utils import metrics
+from .utils.auth import api_key_cache, api_key_negative_cache, api_key_flight
+from .sso import verify_flight, renew_flight
+from .utils.passwords import PasswordPool
+from .utils.throttle import LoginThrottle
+from .utils.revocations import RevocationFilter
+from .utils.tracing import TracingMiddleware, TraceExporter
+from .sweeper import TokenSweeper
+from .password_costs import PasswordCostMonitor
+from .config import APP_VERSION, DEBUG, MONGO_ENSURE_INDEXES, TRACING_ENABLED
+from .migrations import ensure_indexes_at_startup, WarmUp, TokenExpiryBackfill
 from .utils.response import DJSONResponse
 from .utils.exceptions import WebException, web_exception_handler, starlette_http_exception_handler, validation_exception_handler
-from .web_services import router
+from .web_services import router, health_router
 
 
 
@@ -13,6 +24,10 @@ tags_metadata = [
         "name": "Info",
         "description": "Servizi informativi",
     },
+    {
+        "name": "Health",
+        "description": "Sonde di liveness e readiness per il load balancer",
+    },
     {
         "name": "Authentication Services",
         "description": "Servizi per l'autenticazione",
@@ -40,10 +55,40 @@ app = fastapi.FastAPI(
     default_response_class=DJSONResponse
 )
 app.add_event_handler("startup", Database.connect)
+if MONGO_ENSURE_INDEXES:
+    app.add_event_handler("startup", ensure_indexes_at_startup)
+app.add_event_handler("startup", PasswordPool.start)
+app.add_event_handler("startup", RevocationFilter.open)
+app.add_event_handler("startup", TokenSweeper.start)
+app.add_event_handler("startup", PasswordCostMonitor.start)
+app.add_event_handler("startup", TokenExpiryBackfill.start)
+app.add_event_handler("startup", WarmUp.start)
+app.add_event_handler("shutdown", WarmUp.stop)
+app.add_event_handler("shutdown", TokenSweeper.stop)
+app.add_event_handler("shutdown", PasswordCostMonitor.stop)
+app.add_event_handler("shutdown", TokenExpiryBackfill.stop)
 app.add_event_handler("shutdown", Database.disconnect)
+app.add_event_handler("shutdown", PasswordPool.stop)
+app.add_event_handler("shutdown", RevocationFilter.close)
+app.add_event_handler("shutdown", TraceExporter.close)
+app.add_event_handler("shutdown", metrics.mark_process_dead)
+
+app.add_middleware(metrics.MetricsMiddleware)
+if TRACING_ENABLED:
+    app.add_middleware(TracingMiddleware)
+metrics.register_stats("mongo_pool", Database.pool_monitor.stats)
+metrics.register_stats("password_pool", PasswordPool.stats)
+metrics.register_stats("api_key_cache", api_key_cache.stats)
+metrics.register_stats("api_key_negative_cache", api_key_negative_cache.stats)
+metrics.register_stats("token_cache", token_cache.stats)
+metrics.register_stats("login_throttle", LoginThrottle.stats)
+metrics.register_stats("revocation_filter", RevocationFilter.stats)
+for flight in (verify_flight, renew_flight, api_key_flight):
+    metrics.register_stats(f"single_flight_{flight.name}", flight.stats)
 
 app.add_exception_handler(WebException, web_exception_handler)
 app.add_exception_handler(StarletteHTTPException, starlette_http_exception_handler)
 app.add_exception_handler(fastapi.exceptions.RequestValidationError, validation_exception_handler)
 
+app.include_router(health_router)
 app.include_router(router)
\ No newline at end of file
@@ -0,0 +1,150 @@
+import asyncio
+from loguru import logger
+from typing import Optional
+from pymongo.errors import PyMongoError
+from .database import Database
+from .leases import Lease
+from .models import user_repo, registered_service_repo
+from .config import LOGIN_THROTTLE_BACKEND, TOKEN_EXPIRY_LEGACY, TOKEN_EXPIRY_BACKFILL, MONGO_WARM_UP
+from .utils.throttle import LoginThrottle
+
+
+REPOSITORIES = [user_repo, registered_service_repo]
+
+
+async def ensure_indexes():
+    """Creates or reconciles the indexes declared on every repository"""
+    logger.info(f"{Database.log_prefix}🗂️  Ensuring indexes...")
+    for repo in REPOSITORIES:
+        await repo.ensure_indexes()
+    if LOGIN_THROTTLE_BACKEND == "mongo":
+        await LoginThrottle.store.ensure_indexes()
+    logger.info(f"{Database.log_prefix}✔️  Indexes ready.")
+
+
+INDEXES_LEASE = Lease("ensure-indexes", ttl=600)
+
+
+async def ensure_indexes_at_startup(poll: float = 1.0):
+    """Startup reconciliation, serialized across workers by a lease
+
+    Two workers reconciling a changed index at once would drop or build it twice and fail their startup. Every
+    worker waits for its turn, so none serves before the indexes exist: the first one rebuilds what changed, the
+    next ones find the indexes up to date.
+    """
+    while not await INDEXES_LEASE.acquire():
+        await asyncio.sleep(poll)
+    try:
+        await ensure_indexes()
+    finally:
+        await INDEXES_LEASE.release()
+
+
+class WarmUp:
+    """Warm up of the connection pool and the collections of every repository (Consider it as a Singleton)
+
+    It runs once at startup, ``/health/ready`` only reports whether it completed. When it fails the worker stays
+    not ready and retries in the background.
+    """
+    task: Optional[asyncio.Task] = None
+    retry_interval = 5.0
+
+    @classmethod
+    async def start(cls):
+        if not MONGO_WARM_UP:
+            Database.ready = True
+        elif not await cls.attempt() and cls.task is None:
+            cls.task = asyncio.create_task(cls.run())
+
+    @classmethod
+    async def stop(cls):
+        if cls.task is not None:
+            cls.task.cancel()
+            cls.task = None
+
+    @classmethod
+    async def attempt(cls) -> bool:
+        try:
+            await Database.warm_up([repo.model for repo in REPOSITORIES])
+        except PyMongoError:
+            logger.exception(f"{Database.log_prefix}❌ MongoDB warm up failed.")
+            return False
+        return True
+
+    @classmethod
+    async def run(cls):
+        while True:
+            await asyncio.sleep(cls.retry_interval)
+            if await cls.attempt():
+                cls.task = None
+                return
+
+
+async def log_index_sizes():
+    for repo in REPOSITORIES:
+        sizes = await Database.index_sizes(repo.model)
+        for name, size in sizes.items():
+            logger.info(f"{Database.log_prefix}📏 Index {repo.model.__collection__}.{name}: {size / 1024:.1f} KiB")
+
+
+async def backfill_token_keys(batch_size: int = 1000):
+    """Online migration storing the digest keys of tokens issued before they existed"""
+    logger.info(f"{Database.log_prefix}🔑 Backfilling token keys...")
+    total = 0
+    while migrated := await user_repo.backfill_token_keys(batch_size):
+        total += migrated
+        logger.info(f"{Database.log_prefix}🔑 {total} tokens migrated...")
+    logger.info(f"{Database.log_prefix}✔️  Token keys backfilled ({total} tokens).")
+
+
+async def backfill_token_expiry(batch_size: int = 1000, pause: float = 0, lease: Optional[Lease] = None):
+    """Online migration storing the expiry of tokens issued before it was stored, so lookups can filter on it
+
+    With a lease, it is renewed before every batch and the migration stops when another worker took it over.
+    """
+    logger.info(f"{Database.log_prefix}⏳ Backfilling token expiry...")
+    total = 0
+    while migrated := await user_repo.backfill_token_expiry(batch_size):
+        total += migrated
+        logger.info(f"{Database.log_prefix}⏳ {total} tokens migrated...")
+        await asyncio.sleep(pause)
+        if lease and not await lease.acquire():
+            logger.info(f"{Database.log_prefix}⏳ Token expiry backfill handed over ({total} tokens migrated).")
+            return
+    logger.info(f"{Database.log_prefix}✔️  Token expiry backfilled ({total} tokens).")
+
+
+class TokenExpiryBackfill:
+    """Token expiry backfill running in the app event loop while legacy lookups are on (Consider it as a Singleton)
+
+    Every worker starts it, only the holder of the lease migrates. The others retry every lease period until they
+    get it once, in case the holder dies halfway: the batches already migrated are not read again.
+    """
+    task: Optional[asyncio.Task] = None
+    batch_size = 500
+    pause = 0.1
+    lease = Lease("token-expiry-backfill", ttl=60)
+
+    @classmethod
+    async def start(cls):
+        if TOKEN_EXPIRY_LEGACY and TOKEN_EXPIRY_BACKFILL and cls.task is None:
+            cls.task = asyncio.create_task(cls.run())
+
+    @classmethod
+    async def stop(cls):
+        if cls.task is not None:
+            cls.task.cancel()
+            cls.task = None
+            await cls.lease.release()
+
+    @classmethod
+    async def run(cls):
+        try:
+            while not await cls.lease.acquire():
+                await asyncio.sleep(cls.lease.ttl)
+            await backfill_token_expiry(cls.batch_size, pause=cls.pause, lease=cls.lease)
+            await cls.lease.release()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception(f"{Database.log_prefix}❌ Token expiry backfill failed.")
@@ -1,12 +1,21 @@
+import asyncio
+import hashlib
 import datetime
 import secrets
-from typing import Optional
-from odmantic import Model, Field, EmbeddedModel
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from odmantic import Model, Field, EmbeddedModel, ObjectId
 from odmantic.query import QueryExpression
 from pydantic import SecretStr
+from pymongo import IndexModel, ASCENDING
+from pymongo.errors import DuplicateKeyError
 from .database import BaseRepository
-from .utils.exceptions import NotFound, Conflict
-from .config import password_context
+from .utils.exceptions import WebException, NotFound, Conflict, CantPerform
+from .utils.passwords import hash_password
+from .utils.cache import TTLCache
+from .config import TOKEN_CACHE_SIZE, TOKEN_CACHE_MAX_STALENESS, TOKEN_LOOKUP_LEGACY, TOKEN_EXPIRY_LEGACY, PASSWORD_WORKERS
+
+
+DUPLICATE_KEY_ERROR = 11000
 
 
 class NotUnique(Conflict):
@@ -17,20 +26,72 @@ def generate_token_value():
     return secrets.token_urlsafe(128)
 
 
+def token_key(value: str) -> bytes:
+    """Fixed-size digest of a token, stored as BSON Binary and indexed in place of the token itself"""
+    return hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+
+
+def token_lookup(kind: str, *values: str) -> dict:
+    """Query matching ``access`` or ``refresh`` tokens by their digest key
+
+    While ``TOKEN_LOOKUP_LEGACY`` is on, tokens whose key has not been backfilled yet also match by value.
+    """
+    keys = [token_key(value) for value in values]
+    query = {f"token.{kind}_key": keys[0] if len(keys) == 1 else {"$in": keys}}
+    if TOKEN_LOOKUP_LEGACY:
+        legacy = {f"token.{kind}_value": values[0] if len(values) == 1 else {"$in": list(values)}}
+        return {"$or": [query, legacy]}
+    return query
+
+
+def token_unexpired(kind: str) -> dict:
+    """Query matching unexpired ``access`` or ``refresh`` tokens on their stored expiry, valid ones only for access
+
+    While ``TOKEN_EXPIRY_LEGACY`` is on, tokens whose expiry has not been backfilled yet also match,
+    their expiry is checked once loaded.
+    """
+    field = f"token.{kind}_expires_at"
+    query = {field: {"$gt": datetime.datetime.utcnow()}}
+    if TOKEN_EXPIRY_LEGACY:
+        query = {"$or": [query, {field: None}]}
+    if kind == "access":
+        query["token.is_valid"] = True
+    return query
+
+
+def token_query(kind: str, *values: str) -> dict:
+    """Lookup of unexpired tokens by value, the expiry is filtered by the same index"""
+    return {"$and": [token_lookup(kind, *values), token_unexpired(kind)]}
+
+
 class UserToken(EmbeddedModel):
     access_value: str = Field(default_factory=generate_token_value)
     refresh_value: str = Field(default_factory=generate_token_value)
+    access_key: Optional[bytes]
+    refresh_key: Optional[bytes]
+    access_expires_at: Optional[datetime.datetime]
+    refresh_expires_at: Optional[datetime.datetime]
     access_lifetime: float = datetime.timedelta(hours=10).total_seconds()
     refresh_lifetime: float = datetime.timedelta(hours=10, minutes=30).total_seconds()
     is_valid: bool
     created: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
 
+    def access_eol(self) -> datetime.datetime:
+        return self.created + datetime.timedelta(seconds=self.access_lifetime)
+
+    def seal(self) -> "UserToken":
+        """Computes the derived fields stored for indexed lookups and server-side expiry"""
+        self.access_key = token_key(self.access_value)
+        self.refresh_key = token_key(self.refresh_value)
+        self.access_expires_at = self.access_eol()
+        self.refresh_expires_at = self.created + datetime.timedelta(seconds=self.refresh_lifetime)
+        return self
+
     def is_valid_access_token(self):
-        eol = self.created + datetime.timedelta(seconds=self.access_lifetime)
-        return datetime.datetime.utcnow() <= eol and self.is_valid
+        return datetime.datetime.utcnow() <= (self.access_expires_at or self.access_eol()) and self.is_valid
     
     def is_valid_refresh_token(self):
-        eol = self.created + datetime.timedelta(seconds=self.refresh_lifetime)
+        eol = self.refresh_expires_at or self.created + datetime.timedelta(seconds=self.refresh_lifetime)
         return datetime.datetime.utcnow() <= eol
 
 
@@ -38,6 +99,7 @@ class User(Model):
     username: str
     password: str
     token: Optional[UserToken]
+    token_generation: int = 0
     created: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
     updated: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
 
@@ -46,46 +108,333 @@ class User(Model):
         collection = "users"
 
 
+class UserView(NamedTuple):
+    """Public fields of a user, fetched without the password hash and the token"""
+    id: ObjectId
+    username: str
+    created: datetime.datetime
+    updated: datetime.datetime
+
+
+token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_MAX_STALENESS)
+
+
+def cache_verified_user(user: User):
+    """Caches a verified user by access token, never beyond the token end of life"""
+    remaining = (user.token.access_eol() - datetime.datetime.utcnow()).total_seconds()
+    token_cache.set(user.token.access_value, user, ttl=min(TOKEN_CACHE_MAX_STALENESS, remaining))
+
+
+def forget_verified_user(user: Optional[User]):
+    if user and user.token:
+        token_cache.invalidate(user.token.access_value)
+
+
+def forget_cached_docs(docs: List[dict]):
+    """Drops the cached users of raw documents projected on ``token.access_value``"""
+    for doc in docs:
+        if doc.get("token"):
+            token_cache.invalidate(doc["token"]["access_value"])
+
+
 class UserRepository(BaseRepository):
     model = User
+    legacy_token_indexes = [
+        IndexModel([("token.access_value", ASCENDING)], name="token_access_value"),
+        IndexModel([("token.refresh_value", ASCENDING)], name="token_refresh_value"),
+    ]
+    indexes = [
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+        IndexModel(
+            [("token.access_key", ASCENDING), ("token.is_valid", ASCENDING), ("token.access_expires_at", ASCENDING)],
+            name="token_access_lookup"
+        ),
+        IndexModel([("token.refresh_key", ASCENDING), ("token.refresh_expires_at", ASCENDING)], name="token_refresh_lookup"),
+        IndexModel([("token.is_valid", ASCENDING), ("token.access_expires_at", ASCENDING)], name="token_access_expiry"),
+        IndexModel([("token.refresh_expires_at", ASCENDING)], name="token_refresh_expiry"),
+    ] + (legacy_token_indexes if TOKEN_LOOKUP_LEGACY else [])
+    obsolete_indexes = ["token_access_key", "token_refresh_key"] + ([] if TOKEN_LOOKUP_LEGACY else ["token_access_value", "token_refresh_value"])
+    destroy_projection = {"_id": 1, "token.access_value": 1}
 
     async def sign_up(self, username: str, password: SecretStr):
-        exists = await self.db.engine.find_one(self.model, self.model.username == username)
-        if exists:
+        pwd = await hash_password(password.get_secret_value())
+        try:
+            return await self.insert({"username": username, "password": pwd})
+        except DuplicateKeyError:
             raise NotUnique("Username is not unique")
-        pwd = password_context.hash(password.get_secret_value().encode("utf-8"))
-        return await self.insert({"username": username, "password": pwd})
-
-    async def partial_update(self, instance: Model, data: dict) -> Optional[Model]:
-        if username := data.get('username'):
-            exists = await self.db.engine.find_one(self.model, self.model.username == username)
-            if exists and exists.id != instance.id:
-                raise NotUnique("Username is not unique")
+
+    async def partial_update(self, id: str, data: dict) -> Optional[User]:
         if passw := data.get('password'):
-            data['password'] = password_context.hash(passw.encode("utf-8"))
-        return await super().partial_update(instance, data)
+            data['password'] = await hash_password(passw)
+        try:
+            inst = await super().partial_update(id, data)
+        except DuplicateKeyError:
+            raise NotUnique("Username is not unique")
+        forget_verified_user(inst)
+        return inst
 
     async def retrive_by_username(self, username: str) -> User:
-        inst = await self.db.engine.find_one(self.model, self.model.username == username)
+        inst = await self.find_one({"username": username})
         if not inst:
             raise NotFound("User not found.")
         return inst
 
     async def retrieve_by_access_token(self, access_token: str) -> User:
-        inst = await self.db.engine.find_one(self.model, {'token.access_value': {"$eq": access_token}})
-        if not inst:
+        inst = await self.find_one(token_query("access", access_token))
+        if not inst or inst.token.access_value != access_token:
             raise NotFound("User not found.")
         return inst
     
+    async def retrieve_by_access_tokens(self, access_tokens: List[str]) -> List[User]:
+        return await self.find_many(token_query("access", *access_tokens))
+
     async def retrieve_by_refresh_token(self, refresh_token: str) -> User:
-        inst = await self.db.engine.find_one(self.model, {'token.refresh_value': {"$eq": refresh_token}})
-        if not inst:
+        inst = await self.find_one(token_query("refresh", refresh_token))
+        if not inst or inst.token.refresh_value != refresh_token:
             raise NotFound("User not found.")
         return inst
     
-    async def invalidate_token(self, user: User) -> User:
-        user.token.is_valid = False
-        return await self.db.engine.save(user)
+    async def backfill_token_keys(self, batch_size: int) -> int:
+        """Stores the digest keys of one batch of tokens created before they existed
+
+        Each update is conditional on the token value, so tokens rotated in the meantime are left alone.
+
+        Returns:
+            int: Number of migrated tokens, 0 when the backfill is complete
+        """
+        docs = await self.execute("find", self.storage.find(
+            self.collection,
+            {"token": {"$ne": None}, "token.access_key": {"$exists": False}},
+            {"token.access_value": 1, "token.refresh_value": 1},
+            limit=batch_size
+        ))
+        if not docs:
+            return 0
+        await self.execute("bulk_write", self.storage.bulk_update(self.collection, [
+            (
+                {"_id": doc["_id"], "token.access_value": doc["token"]["access_value"]},
+                {"$set": {
+                    "token.access_key": token_key(doc["token"]["access_value"]),
+                    "token.refresh_key": token_key(doc["token"]["refresh_value"])
+                }}
+            )
+            for doc in docs
+        ]))
+        return len(docs)
+
+    async def backfill_token_expiry(self, batch_size: int) -> int:
+        """Stores the expiry of one batch of tokens created before it was stored
+
+        Each update is conditional on the token value, so tokens rotated in the meantime are left alone.
+
+        Returns:
+            int: Number of migrated tokens, 0 when the backfill is complete
+        """
+        docs = await self.execute("find", self.storage.find(
+            self.collection,
+            {"token": {"$ne": None}, "token.refresh_expires_at": None},
+            {"token.access_value": 1, "token.created": 1, "token.access_lifetime": 1, "token.refresh_lifetime": 1},
+            limit=batch_size
+        ))
+        if not docs:
+            return 0
+        operations = []
+        for doc in docs:
+            token = UserToken(is_valid=True, **doc["token"])
+            operations.append((
+                {"_id": doc["_id"], "token.access_value": token.access_value},
+                {"$set": {
+                    "token.access_expires_at": token.access_eol(),
+                    "token.refresh_expires_at": token.created + datetime.timedelta(seconds=token.refresh_lifetime)
+                }}
+            ))
+        await self.execute("bulk_write", self.storage.bulk_update(self.collection, operations))
+        return len(docs)
+
+    async def _expired_ids(self, query: dict, batch_size: int) -> List[ObjectId]:
+        docs = await self.execute("find", self.storage.find(self.collection, query, {"_id": 1}, limit=batch_size))
+        return [doc["_id"] for doc in docs]
+
+    async def sweep_expired_tokens(self, batch_size: int) -> Tuple[int, int]:
+        """Drops tokens past their refresh expiry and invalidates the ones past their access expiry, one batch each
+
+        Args:
+            batch_size (int): Maximum number of users updated per operation
+
+        Returns:
+            Tuple[int, int]: Number of dropped and invalidated tokens
+        """
+        now = datetime.datetime.utcnow()
+        dropped = invalidated = 0
+        query = {"token.refresh_expires_at": {"$lt": now}}
+        if ids := await self._expired_ids(query, batch_size):
+            _, dropped = await self.execute("update_many", self.storage.update(
+                self.collection,
+                {"_id": {"$in": ids}, **query},
+                {"$set": {"token": None}, "$inc": {"token_generation": 1}},
+                multi=True
+            ))
+        query = {"token.is_valid": True, "token.access_expires_at": {"$lt": now}}
+        if ids := await self._expired_ids(query, batch_size):
+            _, invalidated = await self.execute("update_many", self.storage.update(
+                self.collection,
+                {"_id": {"$in": ids}, **query},
+                {"$set": {"token.is_valid": False}},
+                multi=True
+            ))
+        return dropped, invalidated
+
+    async def rehash_password(self, user: User, hashed: str) -> bool:
+        """Replaces a stale password hash, unless the password changed in the meantime
+
+        Returns:
+            bool: Whether the hash was replaced
+        """
+        _, modified = await self.execute("update_one", self.storage.update(
+            self.collection, {"_id": user.id, "password": user.password}, {"$set": {"password": hashed}}
+        ))
+        return bool(modified)
+
+    async def password_costs(self) -> Dict[int, int]:
+        """Counts users by bcrypt cost factor of their password hash, in a single server side pass"""
+        counts = await self.execute("aggregate", self.storage.group_count(self.collection, "password", 4, 2))
+        return {int(cost): users for cost, users in counts.items() if isinstance(cost, str) and cost.isdigit()}
+
+    async def retrieve_token_generation(self, id: str) -> int:
+        """Fetches only the token generation of a user, used to detect revoked signed tokens"""
+        doc = await self.execute("find_one", self.storage.retrieve(self.collection, {"_id": ObjectId(id)}, {"token_generation": 1}))
+        if not doc:
+            raise NotFound("User not found.")
+        return doc.get("token_generation", 0)
+
+    async def rotate_token(self, user: User, token: UserToken, refresh_token: Optional[str] = None) -> Optional[User]:
+        """Atomically replaces the user token in a single round trip
+
+        The update only applies if the token generation is still the one of ``user``
+        (and the refresh token still matches, when given), so concurrent rotations can't overwrite each other.
+
+        Args:
+            user (User): User whose token is rotated
+            token (UserToken): The new token
+            refresh_token (Optional[str], optional): Refresh token being consumed. Defaults to None.
+
+        Returns:
+            Optional[User]: The updated user, None if the token was rotated concurrently
+        """
+        forget_verified_user(user)
+        token.seal()
+        query = {"_id": user.id, "token_generation": user.token_generation or {"$in": [0, None]}}
+        if refresh_token:
+            query.update(token_lookup("refresh", refresh_token))
+        doc = await self.execute("find_one_and_update", self.storage.update_and_fetch(
+            self.collection,
+            query,
+            {"$set": {"token": token.doc(), "token_generation": user.token_generation + 1, "updated": datetime.datetime.utcnow()}}
+        ))
+        return self.model.parse_doc(doc) if doc else None
+
+    async def consume_refresh_token(self, refresh_token: str, token: UserToken) -> Optional[Tuple[User, str]]:
+        """Replaces the token of the owner of an unexpired refresh token in a single round trip
+
+        The document comes back as it was before the update, with the access token being revoked, and the updated
+        user is rebuilt from it. Legacy tokens without a stored expiry are checked on their creation time instead.
+
+        Args:
+            refresh_token (str): Refresh token being consumed
+            token (UserToken): The new token
+
+        Returns:
+            Optional[Tuple[User, str]]: The updated user and the revoked access token, None when the refresh token
+                is unknown, expired or consumed concurrently
+        """
+        now = datetime.datetime.utcnow()
+        token.seal()
+        unexpired = {"token.refresh_expires_at": {"$gt": now}}
+        if TOKEN_EXPIRY_LEGACY:
+            lifetime = datetime.timedelta(seconds=UserToken.__fields__["refresh_lifetime"].default)
+            unexpired = {"$or": [unexpired, {"token.refresh_expires_at": None, "token.created": {"$gt": now - lifetime}}]}
+        doc = await self.execute("find_one_and_update", self.storage.update_and_fetch(
+            self.collection,
+            {"$and": [token_lookup("refresh", refresh_token), unexpired]},
+            {"$set": {"token": token.doc(), "updated": now}, "$inc": {"token_generation": 1}},
+            before=True
+        ))
+        if not doc:
+            return None
+        revoked = doc["token"]["access_value"]
+        token_cache.invalidate(revoked)
+        doc.update(token=token.doc(), token_generation=doc.get("token_generation", 0) + 1, updated=now)
+        return self.model.parse_doc(doc), revoked
+
+    async def drop_token(self, user: User) -> bool:
+        """Drops the user token, unless it was rotated in the meantime
+
+        Returns:
+            bool: Whether the token was dropped
+        """
+        forget_verified_user(user)
+        query = {"_id": user.id}
+        if user.token:
+            query["token.access_value"] = user.token.access_value
+        matched, _ = await self.execute("update_one", self.storage.update(
+            self.collection,
+            query,
+            {"$set": {"token": None, "updated": datetime.datetime.utcnow()}, "$inc": {"token_generation": 1}}
+        ))
+        return bool(matched)
+
+    async def drop_token_by_access_token(self, access_token: str):
+        token_cache.invalidate(access_token)
+        matched, _ = await self.execute("update_one", self.storage.update(
+            self.collection,
+            token_lookup("access", access_token),
+            {"$set": {"token": None, "updated": datetime.datetime.utcnow()}, "$inc": {"token_generation": 1}}
+        ))
+        if not matched:
+            raise NotFound("User not found.")
+
+    async def destroy(self, id: str) -> Optional[User]:
+        inst = await super().destroy(id)
+        forget_verified_user(inst)
+        return inst
+
+    async def destroy_many(self, ids: List[str]) -> List[dict]:
+        docs = await super().destroy_many(ids)
+        forget_cached_docs(docs)
+        return docs
+
+    async def bulk_partial_update(self, updates: List[Tuple[str, dict]]) -> Dict[int, WebException]:
+        """Partially updates many users, reading the existing ones once and writing with a single bulk write
+
+        Passwords are hashed concurrently, bounded by the password pool workers.
+
+        Args:
+            updates (List[Tuple[str, dict]]): User ID and data of every update
+
+        Returns:
+            Dict[int, WebException]: The error of every update that failed, by position
+        """
+        query = {"_id": {"$in": [ObjectId(id) for id, _ in updates]}}
+        docs = await self.execute("find", self.storage.find(self.collection, query, self.destroy_projection))
+        forget_cached_docs(docs)
+        existing = {str(doc["_id"]) for doc in docs}
+        errors = {position: NotFound("User not found.") for position, (id, _) in enumerate(updates) if id not in existing}
+        pending = [(position, id, dict(data)) for position, (id, data) in enumerate(updates) if position not in errors]
+        workers = asyncio.Semaphore(PASSWORD_WORKERS)
+
+        async def hash_update(data: dict):
+            async with workers:
+                data["password"] = await hash_password(data["password"])
+
+        await asyncio.gather(*[hash_update(data) for _, _, data in pending if data.get("password")])
+        write_errors = await super().bulk_partial_update([(id, data) for _, id, data in pending])
+        for index, error in write_errors.items():
+            position = pending[index][0]
+            if error.get("code") == DUPLICATE_KEY_ERROR:
+                errors[position] = NotUnique("Username is not unique")
+            else:
+                errors[position] = CantPerform(error.get("errmsg"))
+        return errors
 
 user_repo = UserRepository()
 
@@ -102,8 +451,11 @@ class RegisteredService(Model):
 
 class RegisteredServiceRepo(BaseRepository):
     model = RegisteredService
+    indexes = [
+        IndexModel([("api_key", ASCENDING)], name="api_key_unique", unique=True),
+    ]
 
     async def retrieve_by_api_key(self, api_key: str) -> Optional[RegisteredService]:
-        return await self.db.engine.find_one(self.model, self.model.api_key == api_key)
+        return await self.find_one({"api_key": api_key})
 
 registered_service_repo = RegisteredServiceRepo()
\ No newline at end of file
@@ -0,0 +1,53 @@
+import asyncio
+from loguru import logger
+from typing import Dict, Optional
+from .config import PASSWORD_COST_STATS_INTERVAL
+from .database import Database
+from .leases import Lease
+from .models import user_repo
+from .utils import metrics
+
+
+async def refresh() -> Dict[int, int]:
+    """Counts users by password hash cost factor and publishes the distribution"""
+    costs = await user_repo.password_costs()
+    metrics.set_password_costs(costs)
+    return costs
+
+
+class PasswordCostMonitor:
+    """Periodic refresh of the password hash cost distribution (Consider it as a Singleton)
+
+    Every worker starts it, only the holder of the lease runs the count; a worker losing the lease zeroes its
+    gauges, so the sum across live workers is the holder's count.
+    """
+    task: Optional[asyncio.Task] = None
+    lease = Lease("password-costs", ttl=2 * PASSWORD_COST_STATS_INTERVAL)
+
+    @classmethod
+    async def start(cls):
+        if PASSWORD_COST_STATS_INTERVAL > 0 and cls.task is None:
+            cls.task = asyncio.create_task(cls.run())
+
+    @classmethod
+    async def stop(cls):
+        if cls.task is not None:
+            cls.task.cancel()
+            cls.task = None
+            await cls.lease.release()
+
+    @classmethod
+    async def run(cls):
+        while True:
+            try:
+                held = cls.lease.held
+                if await cls.lease.acquire():
+                    costs = await refresh()
+                    logger.info(f"{Database.log_prefix}🔐 Password hash costs: {dict(sorted(costs.items()))}")
+                elif held:
+                    metrics.set_password_costs({})
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"{Database.log_prefix}❌ Password hash costs refresh failed.")
+            await asyncio.sleep(PASSWORD_COST_STATS_INTERVAL)
@@ -39,3 +39,21 @@ class Authentication(BaseModel):
 class AuthenticatedUser(BaseBSONModel):
     user: ReadUser
     auth: Authentication
+
+
+# Precompiled encoders for trusted repository output, skipping pydantic revalidation
+
+def encode_read_user(user) -> dict:
+    return {
+        "id": str(user.id),
+        "username": user.username,
+        "created": user.created,
+        "updated": user.updated
+    }
+
+
+def encode_authenticated_user(payload: dict) -> dict:
+    return {
+        "user": encode_read_user(payload["user"]),
+        "auth": payload["auth"]
+    }
@@ -1,29 +1,56 @@
-from .models import user_repo, UserToken
-from .utils.exceptions import Unauthorized, Forbidden
-from .config import password_context
+import asyncio
+from typing import List, Optional, Set, Tuple
+from loguru import logger
+from .models import user_repo, User, UserToken, token_cache, cache_verified_user
+from .utils.cache import MISSING
+from .utils.exceptions import Unauthorized, Forbidden, NotFound, ServiceUnavailable
+from .utils.passwords import check_password, hash_password, reject_password
+from .utils.throttle import LoginThrottle
+from .utils.singleflight import SingleFlight
+from .utils.revocations import RevocationFilter
+from .utils.tokens import TokenError, decode_token, is_signed_token, sign_token
+from .config import TOKEN_FORMAT, PASSWORD_REHASH_ON_LOGIN
 
 
-async def renew_auth(user):
+verify_flight = SingleFlight("verify")
+renew_flight = SingleFlight("renew")
+
+
+async def renew_auth(user, refresh_token: Optional[str] = None):
+    """Mints a new token, concurrent renewals of the same user share a single one"""
+    return await renew_flight.do(user.id, lambda: _renew_auth(user, refresh_token))
+
+
+async def _renew_auth(user, refresh_token: Optional[str] = None):
     auth = UserToken(is_valid=True)
-    return await user_repo.partial_update(user, data={"token": auth})
+    if TOKEN_FORMAT == "signed":
+        auth.access_value = sign_token(str(user.id), user.token_generation + 1, auth.created, auth.access_eol())
+    return await user_repo.rotate_token(user, auth, refresh_token=refresh_token)
 
 
 async def drop_auth(user):
-    user.token = None
-    await user_repo.db.engine.save(user)
+    if await user_repo.drop_token(user) and user.token:
+        RevocationFilter.add(user.token.access_value)
 
 
 async def signout(token: str):
-    user = await user_repo.retrieve_by_access_token(token)
-    await drop_auth(user)
+    await user_repo.drop_token_by_access_token(token)
+    RevocationFilter.add(token)
     return True
 
 
+def cached_user(access_token: str):
+    """The cached owner of a token, MISSING when not cached or possibly revoked by another worker"""
+    if RevocationFilter.contains(access_token):
+        token_cache.invalidate(access_token)
+        return MISSING
+    return token_cache.get(access_token)
+
+
 async def ues(username:str):
     try:
         user = await user_repo.retrive_by_username(username)
         if not user.token.is_valid_access_token():
-            await user_repo.invalidate_token(user)
             raise Exception("Token expired or not valid.")
         return {
             "user": user,
@@ -36,25 +63,126 @@ async def ues(username:str):
         raise Forbidden(str(e))
 
 
+async def verify_signed(access_token: str):
+    try:
+        claims = decode_token(access_token)
+    except TokenError as e:
+        raise Forbidden(str(e))
+    user = await user_repo.retrieve(claims["sub"])
+    if not user or not user.token or user.token_generation != claims["gen"]:
+        raise Forbidden("Token revoked.")
+    cache_verified_user(user)
+    return user
+
+
+async def check(access_token: str) -> bool:
+    """Validates an access token, signed ones are checked against the user token generation only"""
+    if not is_signed_token(access_token):
+        await verify(access_token)
+        return True
+    if cached_user(access_token) is not MISSING:
+        return True
+    try:
+        claims = decode_token(access_token)
+        generation = await user_repo.retrieve_token_generation(claims["sub"])
+    except Exception as e:
+        raise Forbidden(str(e))
+    if generation != claims["gen"]:
+        raise Forbidden("Token revoked.")
+    return True
+
+
 async def verify(access_token: str):
+    user = cached_user(access_token)
+    if user is not MISSING:
+        return user
+    return await verify_flight.do(access_token, lambda: _verify(access_token))
+
+
+async def _verify(access_token: str):
+    if is_signed_token(access_token):
+        return await verify_signed(access_token)
     try:
         user = await user_repo.retrieve_by_access_token(access_token)
         if not user.token.is_valid_access_token():
-            await user_repo.invalidate_token(user)
             raise Exception("Token expired or not valid.")
+        cache_verified_user(user)
         return user
     except Exception as e:
         raise Forbidden(str(e))
 
 
-async def signin(username: str, password: str):
+async def verify_batch(access_tokens: List[str]) -> List[Optional[User]]:
+    """Resolves many access tokens at once, with a single query for the ones not in cache
+
+    Args:
+        access_tokens (List[str]): Access tokens to verify, duplicates are looked up once
+
+    Returns:
+        List[Optional[User]]: The owner of every token in request order, None for the invalid ones
+    """
+    verified = {}
+    pending = []
+    for access_token in set(access_tokens):
+        user = cached_user(access_token)
+        if user is not MISSING:
+            verified[access_token] = user
+            continue
+        if is_signed_token(access_token):
+            try:
+                decode_token(access_token)
+            except TokenError:
+                continue
+        pending.append(access_token)
+    if pending:
+        for user in await user_repo.retrieve_by_access_tokens(pending):
+            if user.token.is_valid_access_token():
+                cache_verified_user(user)
+                verified[user.token.access_value] = user
+    return [verified.get(access_token) for access_token in access_tokens]
+
+
+_rehashes: Set[asyncio.Task] = set()
+
+
+async def rehash_password(user: User, password: str):
+    """Upgrades a stale password hash to the current bcrypt policy, left for a later login when the pool is busy"""
     try:
-        user = await user_repo.retrive_by_username(username)
-        verify = password_context.verify(secret=password.get_secret_value().encode("utf-8"), hash=user.password.encode("utf-8"))
+        await user_repo.rehash_password(user, await hash_password(password))
+    except ServiceUnavailable:
+        pass
+    except Exception:
+        logger.exception(f"Password rehash of user {user.id} failed.")
+
+
+def schedule_rehash(user: User, password: str):
+    """Runs the rehash in the background, the login response doesn't wait for it"""
+    task = asyncio.create_task(rehash_password(user, password))
+    _rehashes.add(task)
+    task.add_done_callback(_rehashes.discard)
+
+
+async def signin(username: str, password: str, service: Optional[str] = None):
+    attempt = {"username": username, "service": service} if service else {"username": username}
+    await LoginThrottle.acquire(**attempt)
+    try:
+        try:
+            user = await user_repo.retrive_by_username(username)
+        except NotFound:
+            # Unknown users cost as much as wrong passwords, without burning a bcrypt slot
+            await reject_password()
+            raise
+        verify, stale = await check_password(password.get_secret_value(), user.password)
         if not verify:
             raise Exception()
+        await LoginThrottle.release(**attempt)
+        if stale and PASSWORD_REHASH_ON_LOGIN:
+            schedule_rehash(user, password.get_secret_value())
         if not user.token or not user.token.is_valid_access_token():
-            user = await renew_auth(user)
+            # A concurrent signin may have rotated the token first: reuse its one
+            user = await renew_auth(user) or await user_repo.retrieve(str(user.id))
+            if not user.token or not user.token.is_valid_access_token():
+                raise Exception()
         return {
             "user": user,
             "auth": {
@@ -62,17 +190,36 @@ async def signin(username: str, password: str):
                 "refresh": user.token.refresh_value
             }
         }
+    except ServiceUnavailable:
+        # The password pool turned the attempt away before checking it: it must not count as a failure
+        await LoginThrottle.release(**attempt)
+        raise
     except Exception:
         raise Unauthorized("Wrong credentials")
 
 
+async def refresh_signed(refresh_token: str) -> Optional[Tuple[User, str]]:
+    """Rotation for signed tokens: they embed the user ID and token generation, so the user is read first"""
+    user = await user_repo.retrieve_by_refresh_token(refresh_token)
+    if not user.token.is_valid_refresh_token():
+        await drop_auth(user)
+        return None
+    revoked = user.token.access_value
+    user = await renew_auth(user, refresh_token=refresh_token)
+    return (user, revoked) if user else None
+
+
 async def refresh(refresh_token: str):
     try:
-        user = await user_repo.retrieve_by_refresh_token(refresh_token)
-        if not user.token.is_valid_refresh_token():
-            await drop_auth(user)
+        if TOKEN_FORMAT == "signed":
+            rotated = await refresh_signed(refresh_token)
+        else:
+            rotated = await user_repo.consume_refresh_token(refresh_token, UserToken(is_valid=True))
+        if not rotated:
             raise Exception()
-        user = await renew_auth(user)
+        user, revoked = rotated
+        if user.token.access_value != revoked:
+            RevocationFilter.add(revoked)
         return {
             "user": user,
             "auth": {
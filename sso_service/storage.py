@@ -0,0 +1,189 @@
+"""Storage backends of the repositories
+
+``BaseRepository`` only talks to a ``Storage``: documents are addressed by collection name, queries use the MongoDB
+filter syntax restricted to ``QUERY_OPERATORS`` and updates the operators of ``UPDATE_OPERATORS``. Both backends
+raise ``pymongo`` errors (``DuplicateKeyError`` on unique index violations).
+"""
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from pymongo import IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from motor.motor_asyncio import AsyncIOMotorClient
+
+QUERY_OPERATORS = ("$and", "$or", "$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in", "$exists")
+UPDATE_OPERATORS = ("$set", "$setOnInsert", "$unset", "$inc")
+
+Sort = List[Tuple[str, int]]
+
+
+class Storage:
+    """Document store interface of the repositories"""
+
+    async def retrieve(self, collection: str, query: dict, projection: Optional[dict] = None) -> Optional[dict]:
+        """First document matching the query, None if there is none"""
+        raise NotImplementedError
+
+    async def find(self, collection: str, query: dict, projection: Optional[dict] = None, sort: Optional[Sort] = None,
+                   limit: int = 0, hint: Optional[str] = None) -> List[dict]:
+        """Documents matching the query, ``limit`` 0 meaning all of them"""
+        raise NotImplementedError
+
+    def iterate(self, collection: str, query: dict, projection: Optional[dict] = None, sort: Optional[Sort] = None,
+                batch_size: int = 1000) -> AsyncIterator[dict]:
+        """Documents matching the query, fetched in batches"""
+        raise NotImplementedError
+
+    async def count(self, collection: str, query: dict, hint: Optional[str] = None) -> int:
+        """Number of documents matching the query, through the ``hint`` index when given"""
+        raise NotImplementedError
+
+    async def group_count(self, collection: str, field: str, start: int, length: int) -> Dict[str, int]:
+        """Counts the documents by a byte slice of a string field, in a single pass"""
+        raise NotImplementedError
+
+    async def insert(self, collection: str, doc: dict):
+        """Inserts a document, raising ``DuplicateKeyError`` on a unique index violation"""
+        raise NotImplementedError
+
+    async def insert_many(self, collection: str, docs: List[dict]) -> Dict[int, dict]:
+        """Inserts many documents unordered, returning the write errors by position, the others are inserted"""
+        raise NotImplementedError
+
+    async def update(self, collection: str, query: dict, update: dict, multi: bool = False,
+                     upsert: bool = False) -> Tuple[int, int]:
+        """Updates the first (or every) matching document, returning the matched and modified counts"""
+        raise NotImplementedError
+
+    async def update_and_fetch(self, collection: str, query: dict, update: dict, projection: Optional[dict] = None,
+                               upsert: bool = False, before: bool = False) -> Optional[dict]:
+        """Updates the first matching document and returns it as updated, or as it was with ``before``
+
+        None if nothing matched, or when ``before`` is set and the document was upserted.
+        """
+        raise NotImplementedError
+
+    async def bulk_update(self, collection: str, updates: List[Tuple[dict, dict]]) -> Dict[int, dict]:
+        """Applies many ``(query, update)`` pairs unordered, returning the write errors by position"""
+        raise NotImplementedError
+
+    async def delete(self, collection: str, query: dict, multi: bool = False) -> int:
+        """Deletes the first (or every) matching document, returning the deleted count"""
+        raise NotImplementedError
+
+    async def delete_and_fetch(self, collection: str, query: dict, projection: Optional[dict] = None) -> Optional[dict]:
+        """Deletes the first matching document and returns it, None if nothing matched"""
+        raise NotImplementedError
+
+    async def index_information(self, collection: str) -> Dict[str, dict]:
+        """Indexes of a collection by name, in the ``index_information`` format of pymongo"""
+        raise NotImplementedError
+
+    async def create_index(self, collection: str, index: IndexModel):
+        raise NotImplementedError
+
+    async def drop_index(self, collection: str, name: str):
+        raise NotImplementedError
+
+    async def index_sizes(self, collection: str) -> Dict[str, int]:
+        """Size in bytes of every index of a collection"""
+        raise NotImplementedError
+
+    async def ping(self):
+        """Round trip to the store, raising when it can't be reached"""
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+
+def _write_errors(e: BulkWriteError) -> Dict[int, dict]:
+    return {error["index"]: error for error in e.details["writeErrors"]}
+
+
+class MongoStorage(Storage):
+    """Storage on a MongoDB database through Motor"""
+
+    def __init__(self, client: AsyncIOMotorClient, database: str):
+        self.client = client
+        self.db = client[database]
+
+    async def retrieve(self, collection: str, query: dict, projection: Optional[dict] = None) -> Optional[dict]:
+        return await self.db[collection].find_one(query, projection)
+
+    async def find(self, collection: str, query: dict, projection: Optional[dict] = None, sort: Optional[Sort] = None,
+                   limit: int = 0, hint: Optional[str] = None) -> List[dict]:
+        cursor = self.db[collection].find(query, projection, sort=sort, limit=limit)
+        if hint:
+            cursor = cursor.hint(hint)
+        return await cursor.to_list(length=None)
+
+    async def iterate(self, collection: str, query: dict, projection: Optional[dict] = None, sort: Optional[Sort] = None,
+                      batch_size: int = 1000) -> AsyncIterator[dict]:
+        async for doc in self.db[collection].find(query, projection, sort=sort, batch_size=batch_size):
+            yield doc
+
+    async def count(self, collection: str, query: dict, hint: Optional[str] = None) -> int:
+        if hint:
+            return await self.db[collection].count_documents(query, hint=hint)
+        return await self.db[collection].count_documents(query)
+
+    async def group_count(self, collection: str, field: str, start: int, length: int) -> Dict[str, int]:
+        pipeline = [{"$group": {"_id": {"$substrBytes": [f"${field}", start, length]}, "count": {"$sum": 1}}}]
+        docs = await self.db[collection].aggregate(pipeline).to_list(length=None)
+        return {doc["_id"]: doc["count"] for doc in docs}
+
+    async def insert(self, collection: str, doc: dict):
+        await self.db[collection].insert_one(doc)
+
+    async def insert_many(self, collection: str, docs: List[dict]) -> Dict[int, dict]:
+        try:
+            await self.db[collection].insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            return _write_errors(e)
+        return {}
+
+    async def update(self, collection: str, query: dict, update: dict, multi: bool = False,
+                     upsert: bool = False) -> Tuple[int, int]:
+        method = self.db[collection].update_many if multi else self.db[collection].update_one
+        result = await method(query, update, upsert=upsert)
+        return result.matched_count, result.modified_count
+
+    async def update_and_fetch(self, collection: str, query: dict, update: dict, projection: Optional[dict] = None,
+                               upsert: bool = False, before: bool = False) -> Optional[dict]:
+        return await self.db[collection].find_one_and_update(
+            query, update, projection, upsert=upsert, return_document=ReturnDocument.BEFORE if before else ReturnDocument.AFTER
+        )
+
+    async def bulk_update(self, collection: str, updates: List[Tuple[dict, dict]]) -> Dict[int, dict]:
+        if not updates:
+            return {}
+        try:
+            await self.db[collection].bulk_write([UpdateOne(query, update) for query, update in updates], ordered=False)
+        except BulkWriteError as e:
+            return _write_errors(e)
+        return {}
+
+    async def delete(self, collection: str, query: dict, multi: bool = False) -> int:
+        method = self.db[collection].delete_many if multi else self.db[collection].delete_one
+        return (await method(query)).deleted_count
+
+    async def delete_and_fetch(self, collection: str, query: dict, projection: Optional[dict] = None) -> Optional[dict]:
+        return await self.db[collection].find_one_and_delete(query, projection)
+
+    async def index_information(self, collection: str) -> Dict[str, dict]:
+        return await self.db[collection].index_information()
+
+    async def create_index(self, collection: str, index: IndexModel):
+        await self.db[collection].create_indexes([index])
+
+    async def drop_index(self, collection: str, name: str):
+        await self.db[collection].drop_index(name)
+
+    async def index_sizes(self, collection: str) -> Dict[str, int]:
+        stats = await self.db.command("collStats", collection)
+        return dict(stats.get("indexSizes", {}))
+
+    async def ping(self):
+        await self.client.admin.command("ping")
+
+    async def close(self):
+        self.client.close()
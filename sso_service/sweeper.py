@@ -0,0 +1,56 @@
+import asyncio
+from loguru import logger
+from typing import Optional
+from .config import TOKEN_SWEEPER_ENABLED, TOKEN_SWEEPER_INTERVAL, TOKEN_SWEEPER_BATCH_SIZE
+from .database import Database
+from .leases import Lease
+from .models import user_repo
+
+
+async def sweep(batch_size: int = TOKEN_SWEEPER_BATCH_SIZE):
+    """Clears expired tokens in batches until none is left"""
+    dropped = invalidated = 0
+    while True:
+        batch_dropped, batch_invalidated = await user_repo.sweep_expired_tokens(batch_size)
+        dropped += batch_dropped
+        invalidated += batch_invalidated
+        if batch_dropped or batch_invalidated:
+            logger.info(f"{Database.log_prefix}🧹 Sweeping tokens: {dropped} dropped, {invalidated} invalidated...")
+        if batch_dropped < batch_size and batch_invalidated < batch_size:
+            break
+    logger.info(f"{Database.log_prefix}✔️  Token sweep done: {dropped} dropped, {invalidated} invalidated.")
+    return dropped, invalidated
+
+
+class TokenSweeper:
+    """Periodic expired tokens sweeper running in the app event loop (Consider it as a Singleton)
+
+    Every worker starts it, only the holder of the lease sweeps.
+    """
+    task: Optional[asyncio.Task] = None
+    lease = Lease("token-sweeper", ttl=2 * TOKEN_SWEEPER_INTERVAL)
+
+    @classmethod
+    async def start(cls):
+        if TOKEN_SWEEPER_ENABLED and cls.task is None:
+            logger.info(f"{Database.log_prefix}🧹 Starting token sweeper (every {TOKEN_SWEEPER_INTERVAL:.0f}s)...")
+            cls.task = asyncio.create_task(cls.run())
+
+    @classmethod
+    async def stop(cls):
+        if cls.task is not None:
+            cls.task.cancel()
+            cls.task = None
+            await cls.lease.release()
+
+    @classmethod
+    async def run(cls):
+        while True:
+            await asyncio.sleep(TOKEN_SWEEPER_INTERVAL)
+            try:
+                if await cls.lease.acquire():
+                    await sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"{Database.log_prefix}❌ Token sweep failed.")
@@ -1,7 +1,12 @@
 from fastapi import Depends
 from fastapi.security import APIKeyHeader
+from .cache import TTLCache, MISSING
 from .exceptions import Forbidden
-from ..config import ADMIN_APIKEY
+from .singleflight import SingleFlight
+from .revocations import RevocationFilter
+from ..config import (
+    ADMIN_APIKEY, API_KEY_CACHE_SIZE, API_KEY_CACHE_TTL, API_KEY_CACHE_NEGATIVE_TTL, API_KEY_CACHE_NEGATIVE_SIZE
+)
 from ..models import RegisteredService, registered_service_repo
 
 
@@ -14,9 +19,30 @@ def check_api_key_admin(auth: str = Depends(ADMIN_API_KEY_HEADER)) -> bool:
 
 
 SERVICE_API_KEY_HEADER = APIKeyHeader(name="X-API-Key", scheme_name="Service API Key")
+api_key_cache = TTLCache(maxsize=API_KEY_CACHE_SIZE, ttl=API_KEY_CACHE_TTL)
+# Unknown keys live in their own smaller cache, so a flood of bad keys can't evict the valid ones
+api_key_negative_cache = TTLCache(maxsize=API_KEY_CACHE_NEGATIVE_SIZE, ttl=API_KEY_CACHE_NEGATIVE_TTL)
+api_key_flight = SingleFlight("api_key")
 
 async def check_api_key(auth: str = Depends(SERVICE_API_KEY_HEADER)) -> RegisteredService:
-    inst = await registered_service_repo.retrieve_by_api_key(auth)
+    """The registered service owning the API key
+
+    Deleted services are recorded in the revocation filter shared by the workers of the host: a maybe revoked key
+    skips the cache, and a lookup racing with the deletion is not cached back.
+    """
+    if RevocationFilter.contains(auth):
+        api_key_cache.invalidate(auth)
+        inst = MISSING
+    else:
+        inst = api_key_cache.get(auth)
+    if inst is MISSING:
+        if api_key_negative_cache.get(auth) is not MISSING:
+            raise Forbidden("Action not permitted")
+        inst = await api_key_flight.do(auth, lambda: registered_service_repo.retrieve_by_api_key(auth))
+        if not inst:
+            api_key_negative_cache.set(auth, True)
+        elif not RevocationFilter.contains(auth):
+            api_key_cache.set(auth, inst)
     if not inst:
         raise Forbidden("Action not permitted")
     return inst
@@ -15,7 +15,9 @@ class WebException(Exception):
         409: "KO_CONFLICT",
         410: "KO_GONE",
         422: "KO_UNPROCESSABLE_PAYLOAD",
-        500: "ERR_CANT_PERFORM"
+        429: "KO_TOO_MANY_REQUESTS",
+        500: "ERR_CANT_PERFORM",
+        503: "ERR_UNAVAILABLE"
     }
 
     status_code: int = ...
@@ -73,6 +75,16 @@ class NotValid(WebException):
     default_message = "Sended data is not valid"
 
 
+class TooManyRequests(WebException):
+    status_code = 429
+    default_message = "Too many requests, retry later."
+
+
+class ServiceUnavailable(WebException):
+    status_code = 503
+    default_message = "Service temporarily unavailable."
+
+
 class ExceptionResponse(WebException):
     status_code = 0
     default_message = "An error has occurred."
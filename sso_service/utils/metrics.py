@@ -0,0 +1,174 @@
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+
+
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+GAUGES_REFRESH_INTERVAL = 1.0
+
+REQUEST_LATENCY = Histogram(
+    "sso_http_request_duration_seconds", "HTTP request latency by route",
+    ["method", "route"]
+)
+RESPONSES = Counter(
+    "sso_http_responses_total", "HTTP responses by route and status code",
+    ["method", "route", "status"]
+)
+DB_QUERY_LATENCY = Histogram(
+    "sso_db_query_duration_seconds", "Database call latency by operation and collection",
+    ["operation", "collection"],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+)
+PASSWORD_LATENCY = Histogram(
+    "sso_password_duration_seconds", "Password hashing CPU time and pool queue wait by operation",
+    ["operation", "phase"],
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+)
+MONGO_POOL_WAIT = Histogram(
+    "sso_mongo_pool_wait_seconds", "Time spent waiting to check out a MongoDB connection",
+    buckets=(.0001, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+)
+PASSWORD_HASH_COSTS = Gauge(
+    "sso_password_hash_cost_users", "Users by bcrypt cost factor of their password hash",
+    ["rounds"],
+    multiprocess_mode="livesum"
+)
+SINGLE_FLIGHT_CALLS = Counter(
+    "sso_single_flight_calls_total", "Coalescable calls by flight, leaders run the call and followers share it",
+    ["flight", "role"]
+)
+RUNTIME_STATS = Gauge(
+    "sso_runtime_stat", "Additive cache and pool statistics, summed across live workers",
+    ["source", "stat"],
+    multiprocess_mode="livesum"
+)
+RUNTIME_LIMITS = Gauge(
+    "sso_runtime_limit", "Configured cache and pool limits, the largest across workers",
+    ["source", "stat"],
+    multiprocess_mode="max"
+)
+RUNTIME_WORKER_STATS = Gauge(
+    "sso_runtime_worker_stat", "Cache and pool ratios, averages and maxima, one series per live worker",
+    ["source", "stat"],
+    multiprocess_mode="liveall"
+)
+# Statistics that are meaningless once summed across workers, every other numeric one is additive
+LIMIT_STATS = {"max_pool_size", "min_pool_size", "maxsize", "queue_size", "slot_size", "hashes", "rotation"}
+WORKER_STATS = {"wait_avg", "wait_max", "verify_latency", "coalesced_ratio"}
+
+STATS_SOURCES: Dict[str, Callable[[], dict]] = {}
+_gauges_refreshed = 0.0
+_password_cost_rounds = set()
+
+
+def register_stats(name: str, source: Callable[[], dict]):
+    """Registers a runtime statistics source, exposed by /stats and as gauges"""
+    STATS_SOURCES[name] = source
+
+
+def collect_stats() -> dict:
+    return {name: source() for name, source in STATS_SOURCES.items()}
+
+
+def refresh_gauges(force: bool = False):
+    """Copies the numeric runtime statistics of this worker into the gauges, at most once per interval
+
+    Each statistic goes to the gauge whose multiprocess mode aggregates it correctly: counts are summed, limits take
+    the largest value and ratios, averages and maxima are kept per worker.
+    """
+    global _gauges_refreshed
+    now = time.monotonic()
+    if not force and now - _gauges_refreshed < GAUGES_REFRESH_INTERVAL:
+        return
+    _gauges_refreshed = now
+    for name, stats in collect_stats().items():
+        for stat, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                if stat in LIMIT_STATS:
+                    gauge = RUNTIME_LIMITS
+                elif stat in WORKER_STATS:
+                    gauge = RUNTIME_WORKER_STATS
+                else:
+                    gauge = RUNTIME_STATS
+                gauge.labels(name, stat).set(value)
+
+
+@contextmanager
+def observe_query(operation: str, collection: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        DB_QUERY_LATENCY.labels(operation, collection).observe(time.perf_counter() - start)
+
+
+def observe_password(operation: str, cost: float, wait: float):
+    PASSWORD_LATENCY.labels(operation, "cpu").observe(cost)
+    PASSWORD_LATENCY.labels(operation, "wait").observe(wait)
+
+
+def observe_pool_wait(wait: float):
+    MONGO_POOL_WAIT.observe(wait)
+
+
+def set_password_costs(costs: Dict[int, int]):
+    """Publishes the users count by hash cost factor, zeroing the cost factors no longer in use"""
+    for rounds in _password_cost_rounds - set(costs):
+        PASSWORD_HASH_COSTS.labels(str(rounds)).set(0)
+    for rounds, users in costs.items():
+        PASSWORD_HASH_COSTS.labels(str(rounds)).set(users)
+    _password_cost_rounds.update(costs)
+
+
+def observe_flight(flight: str, role: str):
+    SINGLE_FLIGHT_CALLS.labels(flight, role).inc()
+
+
+def render_metrics() -> bytes:
+    """Prometheus text exposition, aggregated across workers in multiprocess mode"""
+    refresh_gauges(force=True)
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+async def mark_process_dead():
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency and status code of every HTTP request, labelled by route template"""
+
+    def __init__(self, app):
+        self.app = app
+        self.routes = None
+
+    def route_of(self, scope) -> str:
+        if self.routes is None:
+            self.routes = {route.endpoint: route.path for route in scope["app"].routes if hasattr(route, "endpoint")}
+        return self.routes.get(scope.get("endpoint"), "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = self.route_of(scope)
+            REQUEST_LATENCY.labels(scope["method"], route).observe(time.perf_counter() - start)
+            RESPONSES.labels(scope["method"], route, str(status)).inc()
+            refresh_gauges()
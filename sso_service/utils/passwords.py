@@ -0,0 +1,174 @@
+import os
+import time
+import secrets
+import asyncio
+from loguru import logger
+from typing import Any, Dict, Optional, Tuple
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from .exceptions import ServiceUnavailable
+from .metrics import observe_password
+from .tracing import span
+from ..config import password_context, PASSWORD_EXECUTOR, PASSWORD_WORKERS, PASSWORD_QUEUE_SIZE
+
+
+def _hash(secret: bytes) -> str:
+    return password_context.hash(secret)
+
+
+def _verify_and_check(secret: bytes, hashed: bytes) -> Tuple[bool, bool]:
+    valid = password_context.verify(secret=secret, hash=hashed)
+    return valid, valid and password_context.needs_update(hashed)
+
+
+def _timed(fn, *args) -> Tuple[Any, float]:
+    """Runs in the executor, returning the result and the CPU time it took"""
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+class PasswordPool:
+    """Bounded executor running bcrypt work off the event loop (Consider it as a Singleton)
+
+    It also owns the dummy hash unknown users are checked against, computed once when it starts.
+    """
+    executor: Optional[Executor] = None
+    dummy_hash: Optional[str] = None
+    in_flight = 0
+    completed = 0
+    rejected = 0
+    latency: Dict[str, float] = {}
+    latency_weight = 0.1
+    log_prefix = f"<> [{os.getpid()}] Server>> "
+
+    @classmethod
+    async def start(cls):
+        """Instantiates the password executor"""
+        if cls.executor is not None:
+            return
+        logger.info(f"{cls.log_prefix}🔐 Starting password pool ({PASSWORD_EXECUTOR} x{PASSWORD_WORKERS})...")
+        if PASSWORD_EXECUTOR == "process":
+            cls.executor = ProcessPoolExecutor(max_workers=PASSWORD_WORKERS)
+        else:
+            cls.executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="password")
+        if cls.dummy_hash is None:
+            secret = secrets.token_hex(16).encode("utf-8")
+            cls.dummy_hash = await asyncio.get_running_loop().run_in_executor(cls.executor, _hash, secret)
+        logger.info(f"{cls.log_prefix}✔️  Password pool started.")
+
+    @classmethod
+    async def stop(cls):
+        """Shuts down the password executor"""
+        if cls.executor is None:
+            return
+        logger.info(f"{cls.log_prefix}🔐 Stopping password pool...")
+        cls.executor.shutdown(wait=False)
+        cls.executor = None
+        logger.info(f"{cls.log_prefix}✔️  Password pool stopped.")
+
+    @classmethod
+    async def run(cls, fn, *args):
+        """Runs a password function in the executor
+
+        Args:
+            fn (Callable): a picklable module level function
+            *args (tuple): function arguments
+
+        Raises:
+            ServiceUnavailable: when the pool and its queue are saturated
+
+        Returns:
+            Any: The function result
+        """
+        if cls.in_flight >= PASSWORD_WORKERS + PASSWORD_QUEUE_SIZE:
+            cls.rejected += 1
+            raise ServiceUnavailable("Password pool saturated")
+        if cls.executor is None:
+            await cls.start()
+        cls.in_flight += 1
+        start = time.perf_counter()
+        try:
+            with span(f"password.{fn.__name__.strip('_')}") as current:
+                result, cost = await asyncio.get_running_loop().run_in_executor(cls.executor, _timed, fn, *args)
+            elapsed = time.perf_counter() - start
+            if current is not None:
+                current.attrs.update(cpu_ms=round(cost * 1000, 2), wait_ms=round((elapsed - cost) * 1000, 2))
+            observe_password(fn.__name__.strip("_"), cost, elapsed - cost)
+            previous = cls.latency.get(fn.__name__, elapsed)
+            cls.latency[fn.__name__] = previous + cls.latency_weight * (elapsed - previous)
+            return result
+        finally:
+            cls.in_flight -= 1
+            cls.completed += 1
+
+    @classmethod
+    def expected_latency(cls, fn) -> Optional[float]:
+        """Moving average of the latency of a password function, None before its first run"""
+        return cls.latency.get(fn.__name__)
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "executor": PASSWORD_EXECUTOR,
+            "workers": PASSWORD_WORKERS,
+            "queue_size": PASSWORD_QUEUE_SIZE,
+            "in_flight": cls.in_flight,
+            "queued": max(0, cls.in_flight - PASSWORD_WORKERS),
+            "completed": cls.completed,
+            "rejected": cls.rejected,
+            "verify_latency": cls.latency.get(_verify_and_check.__name__, 0.0)
+        }
+
+
+async def hash_password(password: str) -> str:
+    return await PasswordPool.run(_hash, password.encode("utf-8"))
+
+
+async def check_password(password: str, hashed: str) -> Tuple[bool, bool]:
+    """Verifies a password, also telling whether its hash is stale for the current bcrypt policy
+
+    Returns:
+        Tuple[bool, bool]: Whether the password is valid and whether its hash needs an upgrade
+    """
+    return await PasswordPool.run(_verify_and_check, password.encode("utf-8"), hashed.encode("utf-8"))
+
+
+async def reject_password() -> bool:
+    """Takes as long as a failed ``check_password`` without doing its work, for unknown users
+
+    Until the latency average is seeded, it verifies against the dummy hash of the pool: unknown users never
+    pay for a hash.
+    """
+    expected = PasswordPool.expected_latency(_verify_and_check)
+    if expected is not None:
+        await asyncio.sleep(expected)
+        return False
+    if PasswordPool.dummy_hash is None:
+        await PasswordPool.start()
+    await PasswordPool.run(_verify_and_check, secrets.token_hex(16).encode("utf-8"), PasswordPool.dummy_hash.encode("utf-8"))
+    return False
+
+
+def hash_rounds(hashed: str) -> Optional[int]:
+    """Cost factor of a bcrypt hash (``$2b$12$...``), None for other formats"""
+    if hashed and hashed.startswith("$2") and hashed[4:6].isdigit():
+        return int(hashed[4:6])
+    return None
+
+
+def calibrate_rounds(target: float, samples: int = 3, base_rounds: int = 10) -> Tuple[int, Dict[int, float]]:
+    """Measures bcrypt on this host, each extra round doubling the cost
+
+    Args:
+        target (float): Hashing time budget in seconds
+        samples (int, optional): Measures at ``base_rounds``, the fastest is kept. Defaults to 3.
+        base_rounds (int, optional): Cost factor measured. Defaults to 10.
+
+    Returns:
+        Tuple[int, Dict[int, float]]: The highest cost factor within the budget and the estimated seconds by cost factor
+    """
+    handler = password_context.handler("bcrypt").using(rounds=base_rounds)
+    secret = secrets.token_hex(16).encode("utf-8")
+    cost = min(_timed(handler.hash, secret)[1] for _ in range(samples))
+    estimates = {rounds: cost * 2 ** (rounds - base_rounds) for rounds in range(4, 21)}
+    return max([rounds for rounds, seconds in estimates.items() if seconds <= target], default=4), estimates
@@ -1,7 +1,29 @@
 import typing
-from dynaconf import settings
-from fastapi.responses import ORJSONResponse
+import functools
+import orjson
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from starlette.background import BackgroundTask
+from .tracing import span
+from ..config import APP_VERSION
+
+
+@functools.lru_cache(maxsize=256)
+def build_body_metadata(error: bool, code: str, message: str) -> dict:
+    """Envelope metadata, built once per process for every distinct code and message (read-only)"""
+    return {
+        "error": error,
+        "version": APP_VERSION,
+        "code": code,
+        "message": message
+    }
+
+
+def orjson_default(obj: typing.Any) -> typing.Any:
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError
 
 
 class DJSONResponse(ORJSONResponse):
@@ -16,28 +38,35 @@ class DJSONResponse(ORJSONResponse):
             self.body_meta_code = body_meta_code
         if body_meta_message is not None:
             self.body_meta_message = body_meta_message
-        self.body_meta_extra = body_meta_extra or {}
+        self.body_meta_extra = body_meta_extra
         super().__init__(content=content, status_code=status_code, headers=headers, background=background)
 
     @property
     def body_metadata(self):
-        return {
-            "error": self.status_code >= 400,
-            "version": settings.get("APP_VERSION"),
-            "code": self.body_meta_code,
-            "message": self.body_meta_message
-        }
+        return build_body_metadata(self.status_code >= 400, self.body_meta_code, self.body_meta_message)
 
     def wrap_content(self, content: typing.Any) -> dict:
-        out = {
-            "meta": dict(**self.body_metadata, **self.body_meta_extra) if self.body_meta_extra else self.body_metadata,
-        }
+        meta = self.body_metadata
+        if self.body_meta_extra:
+            meta = {**meta, **self.body_meta_extra}
         if self.status_code >= 400:
-            out['reason'] = content
-        else:
-            out['data'] = content
-        return out
+            return {"meta": meta, "reason": content}
+        return {"meta": meta, "data": content}
 
     def render(self, content: typing.Any) -> bytes:
-        return super().render(self.wrap_content(content))
+        with span("render"):
+            return orjson.dumps(self.wrap_content(content), default=orjson_default)
+
+
+class NDJSONStreamingResponse(StreamingResponse):
+    media_type = "application/x-ndjson"
+
+    def __init__(
+            self, content: typing.AsyncIterable, encoder: typing.Callable = jsonable_encoder,
+            status_code: int = 200, headers: dict = None, background: BackgroundTask = None) -> None:
+        super().__init__(content=self.lines(content, encoder), status_code=status_code, headers=headers, background=background)
 
+    @staticmethod
+    async def lines(content: typing.AsyncIterable, encoder: typing.Callable) -> typing.AsyncIterator[bytes]:
+        async for item in content:
+            yield orjson.dumps(encoder(item)) + b"\n"
@@ -0,0 +1,155 @@
+import os
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+from loguru import logger
+from typing import Optional
+from ..config import (
+    REVOCATION_FILTER_ENABLED, REVOCATION_FILTER_PATH, REVOCATION_FILTER_SIZE, REVOCATION_FILTER_HASHES,
+    REVOCATION_FILTER_ROTATION, TOKEN_CACHE_MAX_STALENESS, API_KEY_CACHE_TTL
+)
+
+
+# magic, version, bytes per slot, rotation period, hashes, epoch of slot 0, epoch of slot 1
+HEADER = struct.Struct("<4sIQdI4xqq")
+HEADER_SIZE = 64
+STAMPS_OFFSET = HEADER.size - 16
+MAGIC = b"LSRF"
+VERSION = 1
+
+
+STAMPS = struct.Struct("<qq")
+
+
+def token_positions(token: str, bits: int, hashes: int):
+    """Bit positions of a token, 32 bits of a single digest each (up to 16 hashes)"""
+    digest = hashlib.blake2b(token.encode("utf-8"), digest_size=4 * hashes, person=b"revocations").digest()
+    return [value % bits for value in struct.unpack(f"<{hashes}I", digest)]
+
+
+class RevocationFilter:
+    """Bloom filter of revoked access tokens and API keys, memory mapped and shared by the workers of a host (Consider it as a Singleton)
+
+    The filter has two slots, stamped with the rotation epoch they were written in: the current one receives
+    revocations and the previous one is still read, so a revocation is remembered for at least a rotation period
+    before its slot is reused. Reads are lock-free, writers serialize on ``flock``.
+
+    A hit only means *maybe revoked*: the caller skips its own cache and asks the database. The filter only has
+    to outlive the cache entries it overrides, so the period defaults to the longest of the token and API key
+    caches time to live. For the same reason it starts empty: the caches of freshly started workers are empty too.
+    """
+    mm: Optional[mmap.mmap] = None
+    fd: Optional[int] = None
+    slot_size = REVOCATION_FILTER_SIZE
+    bits = REVOCATION_FILTER_SIZE * 8
+    hashes = REVOCATION_FILTER_HASHES
+    period = REVOCATION_FILTER_ROTATION or max(TOKEN_CACHE_MAX_STALENESS, API_KEY_CACHE_TTL)
+    hits = 0
+    misses = 0
+    log_prefix = f"<> [{os.getpid()}] Server>> "
+
+    @classmethod
+    def open(cls, path: str = REVOCATION_FILTER_PATH):
+        """Maps the shared filter, creating it empty when missing or built with other parameters"""
+        if not REVOCATION_FILTER_ENABLED or cls.mm is not None:
+            return
+        size = HEADER_SIZE + 2 * cls.slot_size
+        cls.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(cls.fd).st_size not in (0, size):
+            # Sized for other settings and maybe still mapped by old workers: replace it, never truncate it under them
+            os.close(cls.fd)
+            os.unlink(path)
+            cls.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(cls.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(cls.fd).st_size != size:
+                os.ftruncate(cls.fd, size)
+            cls.mm = mmap.mmap(cls.fd, size)
+            header = HEADER.unpack_from(cls.mm, 0)
+            if header[:5] != (MAGIC, VERSION, cls.slot_size, cls.period, cls.hashes):
+                cls.mm[:] = bytes(size)
+                HEADER.pack_into(cls.mm, 0, MAGIC, VERSION, cls.slot_size, cls.period, cls.hashes, -1, -1)
+        finally:
+            fcntl.flock(cls.fd, fcntl.LOCK_UN)
+        logger.info(f"{cls.log_prefix}🚫 Revocation filter mapped ({path}, {size / 1024 ** 2:.1f} MiB).")
+
+    @classmethod
+    def close(cls):
+        if cls.mm is not None:
+            cls.mm.close()
+            os.close(cls.fd)
+            cls.mm = cls.fd = None
+
+    @classmethod
+    def epoch(cls) -> int:
+        return int(time.time() // cls.period)
+
+    @classmethod
+    def stamps(cls) -> tuple:
+        """Rotation epoch each slot was last cleared in"""
+        return STAMPS.unpack_from(cls.mm, STAMPS_OFFSET)
+
+    @classmethod
+    def add(cls, *tokens: str):
+        """Records revoked access tokens, visible to every worker as soon as it returns"""
+        if cls.mm is None or not tokens:
+            return
+        epoch = cls.epoch()
+        slot = epoch % 2
+        start = HEADER_SIZE + slot * cls.slot_size
+        fcntl.flock(cls.fd, fcntl.LOCK_EX)
+        try:
+            if cls.stamps()[slot] != epoch:
+                # The slot holds revocations two rotations old: clear it before stamping it current
+                cls.mm[start:start + cls.slot_size] = bytes(cls.slot_size)
+                struct.pack_into("<q", cls.mm, STAMPS_OFFSET + 8 * slot, epoch)
+            for token in tokens:
+                for position in token_positions(token, cls.bits, cls.hashes):
+                    offset = start + (position >> 3)
+                    cls.mm[offset] |= 1 << (position & 7)
+        finally:
+            fcntl.flock(cls.fd, fcntl.LOCK_UN)
+
+    @classmethod
+    def contains(cls, token: str) -> bool:
+        """Whether a token may have been revoked, False for sure when it has not"""
+        if cls.mm is None:
+            return False
+        epoch = int(time.time() // cls.period)
+        stamps = cls.stamps()
+        positions = None
+        for slot_epoch in (epoch, epoch - 1):
+            slot = slot_epoch % 2
+            if stamps[slot] != slot_epoch:
+                continue
+            positions = positions or token_positions(token, cls.bits, cls.hashes)
+            mm, start = cls.mm, HEADER_SIZE + slot * cls.slot_size
+            if all(mm[start + (position >> 3)] >> (position & 7) & 1 for position in positions):
+                cls.hits += 1
+                return True
+        cls.misses += 1
+        return False
+
+    @classmethod
+    def stats(cls) -> dict:
+        if cls.mm is None:
+            return {"enabled": False}
+        epoch = cls.epoch()
+        stamps = cls.stamps()
+        fill = {}
+        for name, slot_epoch in (("current", epoch), ("previous", epoch - 1)):
+            slot = slot_epoch % 2
+            start = HEADER_SIZE + slot * cls.slot_size
+            ones = bin(int.from_bytes(cls.mm[start:start + cls.slot_size], "little")).count("1")
+            fill[name] = ones / cls.bits if stamps[slot] == slot_epoch else 0.0
+        return {
+            "enabled": True,
+            "slot_size": cls.slot_size,
+            "hashes": cls.hashes,
+            "rotation": cls.period,
+            "fill_ratio": fill,
+            "hits": cls.hits,
+            "misses": cls.misses
+        }
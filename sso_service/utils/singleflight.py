@@ -0,0 +1,46 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+from .metrics import observe_flight
+
+
+class SingleFlight:
+    """Coalesces concurrent calls sharing a key into a single in-flight task, per worker
+
+    The first caller (leader) starts the task, the ones arriving while it runs (followers) await the same result
+    or exception. The task is shielded, a cancelled caller doesn't cancel it for the others.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self.calls.get(key)
+        if task is None:
+            self.leaders += 1
+            observe_flight(self.name, "leader")
+            task = asyncio.ensure_future(fn())
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.followers += 1
+            observe_flight(self.name, "follower")
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Future):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            # Marks the exception as retrieved when every caller went away
+            task.exception()
+
+    def stats(self) -> dict:
+        calls = self.leaders + self.followers
+        return {
+            "in_flight": len(self.calls),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "coalesced_ratio": self.followers / calls if calls else 0.0
+        }
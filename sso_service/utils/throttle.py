@@ -0,0 +1,120 @@
+import time
+import datetime
+from collections import OrderedDict
+from typing import Hashable, Tuple
+from pymongo import IndexModel, ASCENDING
+from .exceptions import TooManyRequests
+from ..database import Database
+from ..config import (
+    LOGIN_THROTTLE_ENABLED, LOGIN_THROTTLE_BACKEND, LOGIN_THROTTLE_WINDOW,
+    LOGIN_THROTTLE_USERNAME_LIMIT, LOGIN_THROTTLE_SERVICE_LIMIT, LOGIN_THROTTLE_MAX_KEYS
+)
+
+
+class MemoryWindowStore:
+    """Per worker attempt counters of the current and previous window, bounded as an LRU"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    async def hit(self, key: Hashable, window: int) -> Tuple[int, int]:
+        """Counts an attempt in the window, returning the previous and current window counts"""
+        start, current, previous = self._data.get(key, (window, 0, 0))
+        if start != window:
+            current, previous = 0, current if start == window - 1 else 0
+        self._data[key] = (window, current + 1, previous)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return previous, current + 1
+
+    async def release(self, key: Hashable, window: int):
+        start, current, previous = self._data.get(key, (None, 0, 0))
+        if start == window and current > 0:
+            self._data[key] = (window, current - 1, previous)
+
+    def size(self) -> int:
+        return len(self._data)
+
+
+class MongoWindowStore:
+    """Attempt counters shared by every worker, one document per key and window expired by a TTL index"""
+    collection_name = "loginThrottle"
+
+    async def ensure_indexes(self):
+        index = IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0)
+        await Database.storage.create_index(self.collection_name, index)
+
+    async def hit(self, key: Hashable, window: int) -> Tuple[int, int]:
+        expires_at = datetime.datetime.utcfromtimestamp((window + 2) * LOGIN_THROTTLE_WINDOW)
+        doc = await Database.storage.update_and_fetch(
+            self.collection_name,
+            {"_id": f"{key}|{window}"},
+            {"$inc": {"count": 1}, "$setOnInsert": {"expires_at": expires_at}},
+            upsert=True
+        )
+        previous = await Database.storage.retrieve(self.collection_name, {"_id": f"{key}|{window - 1}"}, {"count": 1})
+        return (previous or {}).get("count", 0), doc["count"]
+
+    async def release(self, key: Hashable, window: int):
+        await Database.storage.update(self.collection_name, {"_id": f"{key}|{window}", "count": {"$gt": 0}}, {"$inc": {"count": -1}})
+
+    def size(self) -> int:
+        return -1
+
+
+class LoginThrottle:
+    """Sliding window limiter of login attempts (Consider it as a Singleton)
+
+    Every attempt is counted before any password work and refunded when it succeeds, so only
+    failures consume the budget while concurrent floods are still bounded. The rate weighs the
+    previous fixed window by its overlap with the sliding one.
+    """
+    limits = {"username": LOGIN_THROTTLE_USERNAME_LIMIT, "service": LOGIN_THROTTLE_SERVICE_LIMIT}
+    store = MongoWindowStore() if LOGIN_THROTTLE_BACKEND == "mongo" else MemoryWindowStore(LOGIN_THROTTLE_MAX_KEYS)
+    allowed = 0
+    rejected = 0
+
+    @classmethod
+    async def acquire(cls, **keys):
+        """Counts an attempt for every key, e.g. ``acquire(username=..., service=...)``
+
+        When a key is over its limit, the keys counted before it get their hit back: the attempt never reaches
+        the password check, so it must not consume e.g. the budget of a username behind a busy service.
+
+        Raises:
+            TooManyRequests: when any key is over its limit
+        """
+        if not LOGIN_THROTTLE_ENABLED:
+            return
+        now = time.time() / LOGIN_THROTTLE_WINDOW
+        window = int(now)
+        counted = []
+        for kind, key in keys.items():
+            previous, current = await cls.store.hit(f"{kind}:{key}", window)
+            if previous * (1 - (now - window)) + current > cls.limits[kind]:
+                for counted_key in counted:
+                    await cls.store.release(counted_key, window)
+                cls.rejected += 1
+                raise TooManyRequests({"retry_after": int(LOGIN_THROTTLE_WINDOW * (window + 1 - now)) + 1})
+            counted.append(f"{kind}:{key}")
+        cls.allowed += 1
+
+    @classmethod
+    async def release(cls, **keys):
+        """Refunds the attempt counted by ``acquire`` after a successful login"""
+        if not LOGIN_THROTTLE_ENABLED:
+            return
+        window = int(time.time() / LOGIN_THROTTLE_WINDOW)
+        for kind, key in keys.items():
+            await cls.store.release(f"{kind}:{key}", window)
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "backend": LOGIN_THROTTLE_BACKEND,
+            "keys": cls.store.size(),
+            "allowed": cls.allowed,
+            "rejected": cls.rejected
+        }
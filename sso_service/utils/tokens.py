@@ -0,0 +1,86 @@
+import hmac
+import base64
+import hashlib
+import datetime
+import orjson
+from ..config import TOKEN_FORMAT, TOKEN_SIGNING_KEYS, TOKEN_SIGNING_KEY_ID
+
+
+if TOKEN_FORMAT == "signed" and TOKEN_SIGNING_KEY_ID not in TOKEN_SIGNING_KEYS:
+    raise RuntimeError("TOKEN_SIGNING_KEY_ID must reference one of TOKEN_SIGNING_KEYS when TOKEN_FORMAT is 'signed'")
+
+
+class TokenError(ValueError):
+    pass
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+def _signature(key_id: str, body: str) -> bytes:
+    key = str(TOKEN_SIGNING_KEYS[key_id]).encode("utf-8")
+    return hmac.new(key, f"{key_id}.{body}".encode("ascii"), hashlib.sha256).digest()
+
+
+def _timestamp(value: datetime.datetime) -> int:
+    return int(value.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+def is_signed_token(token: str) -> bool:
+    """Opaque tokens are urlsafe base64 strings, so they never contain dots"""
+    return token.count(".") == 2
+
+
+def sign_token(user_id: str, generation: int, issued: datetime.datetime, expires: datetime.datetime) -> str:
+    """Builds a compact HMAC-SHA256 signed access token with the active signing key
+
+    Args:
+        user_id (str): User Object ID
+        generation (int): User token generation, bumped on every revocation
+        issued (datetime.datetime): Issue time (UTC)
+        expires (datetime.datetime): Expiry time (UTC)
+
+    Returns:
+        str: ``<key id>.<claims>.<signature>``
+    """
+    body = _b64encode(orjson.dumps({
+        "sub": user_id,
+        "iat": _timestamp(issued),
+        "exp": _timestamp(expires),
+        "gen": generation
+    }))
+    return f"{TOKEN_SIGNING_KEY_ID}.{body}.{_b64encode(_signature(TOKEN_SIGNING_KEY_ID, body))}"
+
+
+def decode_token(token: str) -> dict:
+    """Checks signature and expiry of a signed access token without any DB access
+
+    Args:
+        token (str): Signed access token
+
+    Raises:
+        TokenError: when the token is malformed, tampered with, signed with an unknown key or expired
+
+    Returns:
+        dict: Token claims
+    """
+    try:
+        key_id, body, signature = token.split(".")
+        if key_id not in TOKEN_SIGNING_KEYS:
+            raise TokenError("Unknown signing key.")
+        if not hmac.compare_digest(_b64decode(signature), _signature(key_id, body)):
+            raise TokenError("Invalid signature.")
+        claims = orjson.loads(_b64decode(body))
+        expires = int(claims["exp"])
+    except TokenError:
+        raise
+    except Exception:
+        raise TokenError("Malformed token.")
+    if expires < _timestamp(datetime.datetime.utcnow()):
+        raise TokenError("Token expired or not valid.")
+    return claims
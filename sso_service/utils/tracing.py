@@ -0,0 +1,134 @@
+import os
+import time
+import random
+import contextlib
+from contextvars import ContextVar
+from typing import List, Optional
+import orjson
+from loguru import logger
+from ..config import TRACING_SLOW_THRESHOLD, TRACING_SAMPLE_RATE, TRACING_EXPORT_PATH
+
+
+class Span:
+    """Timed unit of work in the span tree of a request, a context manager making itself the current span"""
+    __slots__ = ("name", "attrs", "start", "end", "children", "_token")
+
+    def __init__(self, name: str, attrs: Optional[dict] = None):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.children: List["Span"] = []
+
+    def __enter__(self) -> "Span":
+        self._token = current_span.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        self.end = time.perf_counter()
+        current_span.reset(self._token)
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    def walk(self, depth: int = 0):
+        yield depth, self
+        for child in self.children:
+            yield from child.walk(depth + 1)
+
+    def to_dict(self, origin: float) -> dict:
+        return {
+            "name": self.name,
+            "offset_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round(self.duration * 1000, 3),
+            "attrs": self.attrs or {},
+            "children": [child.to_dict(origin) for child in self.children]
+        }
+
+
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+NOOP = contextlib.nullcontext()
+
+
+def span(name: str, **attrs):
+    """Child span of the current one, a shared no-op context manager when the request is not traced"""
+    parent = current_span.get()
+    if parent is None:
+        return NOOP
+    child = Span(name, attrs)
+    parent.children.append(child)
+    return child
+
+
+def db_calls(root: Span) -> int:
+    return sum(1 for _, node in root.walk() if node.name.startswith("db."))
+
+
+def breakdown(root: Span) -> str:
+    lines = []
+    for depth, node in root.walk():
+        attrs = " ".join(f"{key}={value}" for key, value in (node.attrs or {}).items())
+        lines.append(f"{'  ' * depth}{node.name} {node.duration * 1000:.2f} ms {attrs}".rstrip())
+    return "\n".join(lines)
+
+
+class TraceExporter:
+    """Appends sampled traces to a JSON lines file, one write per trace so workers can share it (Consider it as a Singleton)"""
+    fd: Optional[int] = None
+
+    @classmethod
+    def write(cls, trace: dict):
+        if cls.fd is None:
+            if os.path.dirname(TRACING_EXPORT_PATH):
+                os.makedirs(os.path.dirname(TRACING_EXPORT_PATH), exist_ok=True)
+            cls.fd = os.open(TRACING_EXPORT_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(cls.fd, orjson.dumps(trace) + b"\n")
+
+    @classmethod
+    async def close(cls):
+        if cls.fd is not None:
+            os.close(cls.fd)
+            cls.fd = None
+
+
+def finish(root: Span, method: str, path: str, status: int):
+    """Logs the breakdown of slow requests and exports the sampled ones"""
+    duration = root.duration
+    if duration >= TRACING_SLOW_THRESHOLD:
+        logger.warning(
+            f"🐢 Slow request {method} {path} -> {status} in {duration * 1000:.1f} ms, "
+            f"{db_calls(root)} DB round trips\n{breakdown(root)}"
+        )
+    if TRACING_EXPORT_PATH and random.random() < TRACING_SAMPLE_RATE:
+        trace = root.to_dict(root.start)
+        trace.update(
+            trace_id=os.urandom(8).hex(), timestamp=time.time() - duration,
+            method=method, path=path, status=status, db_calls=db_calls(root)
+        )
+        TraceExporter.write(trace)
+
+
+class TracingMiddleware:
+    """ASGI middleware rooting the span tree of every HTTP request, only installed when tracing is enabled"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        root = Span("request")
+        try:
+            with root:
+                await self.app(scope, receive, send_wrapper)
+        finally:
+            finish(root, scope["method"], scope["path"], status)
@@ -1,13 +1,41 @@
-from typing import List
-from pydantic import BaseModel
-from fastapi import APIRouter, Depends
-from .utils.auth import check_api_key, check_api_key_admin
-from .utils.exceptions import NotFound, Forbidden
-from .models import RegisteredService, registered_service_repo, user_repo
-from .serializers import WriteRegisterdService, ReadUser, WriteUser, AuthenticatedUser, Credentials, UpdateUser
-from sso_service import sso
+import codecs
+import tempfile
+from typing import List, Optional
+from bson import ObjectId
+from pydantic import BaseModel, conlist
+from fastapi import APIRouter, Depends, Query, Request, Response
+from starlette.background import BackgroundTask
+from fastapi.encoders import jsonable_encoder
+from .config import PAGINATION_DEFAULT_LIMIT, PAGINATION_MAX_LIMIT, VERIFY_BATCH_MAX_TOKENS, USERS_BATCH_MAX_ITEMS
+from .utils.response import DJSONResponse, NDJSONStreamingResponse
+from .utils.auth import check_api_key, check_api_key_admin, api_key_cache, api_key_negative_cache
+from .utils.exceptions import WebException, BadRequest, NotFound, Forbidden, ServiceUnavailable
+from .utils.revocations import RevocationFilter
+from .utils import metrics
+from .models import RegisteredService, UserView, registered_service_repo, user_repo
+from .serializers import WriteRegisterdService, ReadUser, WriteUser, AuthenticatedUser, Credentials, UpdateUser, \
+    encode_read_user, encode_authenticated_user
+from .database import Database
+from sso_service import sso, importer
 
 router = APIRouter(prefix="/api/v1")
+health_router = APIRouter(prefix="/health", tags=["Health"])
+
+
+@health_router.get("/live", response_model=dict)
+def liveness():
+    """Risponde finché il processo è in grado di servire richieste."""
+    return {"status": "alive"}
+
+
+@health_router.get("/ready", response_model=dict)
+async def readiness():
+    """Risponde solo se il worker ha completato il warm-up e MongoDB è raggiungibile, altrimenti 503."""
+    if not await Database.ping():
+        raise ServiceUnavailable("Database unreachable")
+    if not Database.ready:
+        raise ServiceUnavailable("Not ready")
+    return {"status": "ready", "pool": Database.pool_monitor.stats()}
 
 
 @router.get("/echo/", response_model=dict, name="Echo Service", tags=["Info"])
@@ -20,14 +48,31 @@ def echo_service():
 async def create_registered_service(service: WriteRegisterdService, auth: bool = Depends(check_api_key_admin)):
     """Crea una nuova api key per l'integrazione"""
     instance = await registered_service_repo.insert(service.dict())
+    api_key_negative_cache.invalidate(instance.api_key)
     return instance
 
 
 @router.get("/registered-services", response_model=List[RegisteredService], tags=["Admin"])
-async def list_registered_services(auth: bool = Depends(check_api_key_admin)):
-    """Ritorna la lista di tutti i servizi integrati"""
-    collection = await registered_service_repo.list()
-    return collection
+async def list_registered_services(
+        limit: int = Query(PAGINATION_DEFAULT_LIMIT, ge=1, le=PAGINATION_MAX_LIMIT), after: Optional[str] = None,
+        stream: bool = False, auth: bool = Depends(check_api_key_admin)):
+    """Ritorna la lista dei servizi integrati, paginata per ID (`after`) o in streaming NDJSON (`stream`)"""
+    if stream:
+        return NDJSONStreamingResponse(registered_service_repo.iterate())
+    collection, next_cursor = await registered_service_repo.paginate(limit=limit, after=after)
+    return DJSONResponse(content=jsonable_encoder(collection), body_meta_extra={"next": next_cursor})
+
+
+@router.get("/stats", response_model=dict, tags=["Admin"])
+async def runtime_stats(auth: bool = Depends(check_api_key_admin)):
+    """Ritorna le statistiche di runtime del worker"""
+    return metrics.collect_stats()
+
+
+@router.get("/metrics", tags=["Admin"])
+async def prometheus_metrics(auth: bool = Depends(check_api_key_admin)):
+    """Ritorna le metriche in formato Prometheus, aggregate su tutti i worker"""
+    return Response(content=metrics.render_metrics(), media_type=metrics.CONTENT_TYPE_LATEST)
 
 
 class OperationExit(BaseModel):
@@ -37,7 +82,9 @@ class OperationExit(BaseModel):
 @router.delete("/registered-services/{registered_service_id}", response_model=OperationExit, tags=["Admin"])
 async def delete_registered_service(registered_service_id: str, auth: bool = Depends(check_api_key_admin)):
     """Elimina l'account di un servizio di integrazione"""
-    await registered_service_repo.destroy(registered_service_id)
+    instance = await registered_service_repo.destroy(registered_service_id)
+    api_key_cache.invalidate(instance.api_key)
+    RevocationFilter.add(instance.api_key)
     return {"operation": True}
 
 
@@ -45,27 +92,43 @@ async def delete_registered_service(registered_service_id: str, auth: bool = Dep
 async def create_user(user: WriteUser, service: RegisteredService = Depends(check_api_key)):
     """Crea un nuovo utente"""
     instance = await user_repo.sign_up(**user.dict())
-    return instance.dict()
+    return DJSONResponse(content=encode_read_user(instance), status_code=201)
+
+
+@router.post("/users/import", tags=["Admin"])
+async def import_users(request: Request, format: str = Query("ndjson", regex="^(ndjson|csv)$"), auth: bool = Depends(check_api_key_admin)):
+    """Importa utenti in blocco da uno stream NDJSON o CSV (`username,password`), ritornando in NDJSON l'esito di ogni riga"""
+    upload = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    async for chunk in request.stream():
+        upload.write(chunk)
+    upload.seek(0)
+    return NDJSONStreamingResponse(
+        importer.import_users(codecs.iterdecode(upload, "utf-8"), fmt=format),
+        background=BackgroundTask(upload.close)
+    )
 
 
 @router.get("/users/", response_model=List[ReadUser], tags=["User Services"])
-async def list_users(service: RegisteredService = Depends(check_api_key)):
-    """Ritorna la lista degli utenti"""
-    collection = await user_repo.list()
-    return list(map(lambda u: u.dict(), collection))
+async def list_users(
+        limit: int = Query(PAGINATION_DEFAULT_LIMIT, ge=1, le=PAGINATION_MAX_LIMIT), after: Optional[str] = None,
+        stream: bool = False, service: RegisteredService = Depends(check_api_key)):
+    """Ritorna la lista degli utenti, paginata per ID (`after`) o in streaming NDJSON (`stream`)"""
+    if stream:
+        return NDJSONStreamingResponse(user_repo.iterate(view=UserView), encoder=encode_read_user)
+    collection, next_cursor = await user_repo.paginate(limit=limit, after=after, view=UserView)
+    return DJSONResponse(content=list(map(encode_read_user, collection)), body_meta_extra={"next": next_cursor})
 
 
 @router.put("/users/{user_id}", response_model=ReadUser, tags=["User Services"])
 async def update_user(user_id: str, payload: UpdateUser, service: RegisteredService = Depends(check_api_key)):
     """Modifica un utente"""
-    inst = await user_repo.retrieve(user_id)
-    if not inst:
-        raise NotFound("User not found")
-    updated = await user_repo.partial_update(inst, data={
+    updated = await user_repo.partial_update(user_id, data={
         "username": payload.username, 
         "password": payload.password.get_secret_value() if payload.password else None
     })
-    return updated
+    if not updated:
+        raise NotFound("User not found")
+    return DJSONResponse(content=encode_read_user(updated))
 
 
 @router.delete("/users/{user_id}", response_model=OperationExit, tags=["User Services"])
@@ -78,16 +141,96 @@ async def delete_user(user_id: str, service: RegisteredService = Depends(check_a
 @router.get("/users/{user_id}", response_model=ReadUser, tags=["User Services"])
 async def retrieve_user(user_id: str, service: RegisteredService = Depends(check_api_key)):
     """Ritorna il dettaglio utente"""
-    inst = await user_repo.retrieve(user_id)
+    inst = await user_repo.retrieve(user_id, view=UserView)
     if not inst:
         raise NotFound("User not found")
-    return inst
+    return DJSONResponse(content=encode_read_user(inst))
+
+
+class UserIdsBatch(BaseModel):
+    ids: conlist(str, min_items=1, max_items=USERS_BATCH_MAX_ITEMS)
+
+
+class UserUpdate(UpdateUser):
+    id: str
+
+
+class UserUpdatesBatch(BaseModel):
+    users: conlist(UserUpdate, min_items=1, max_items=USERS_BATCH_MAX_ITEMS)
+
+
+class UserOperation(BaseModel):
+    id: str
+    operation: bool
+    code: str
+    reason: Optional[str]
+    user: Optional[ReadUser]
+
+
+def user_operation(user_id: str, exc: WebException = None, user=None) -> dict:
+    return {
+        "id": user_id,
+        "operation": exc is None,
+        "code": exc.exc_code if exc else "OK",
+        "reason": exc.reason if exc else None,
+        "user": encode_read_user(user) if user is not None else None
+    }
+
+
+INVALID_ID = BadRequest("Invalid ID")
+
+
+@router.post("/users/retrieve-batch", response_model=List[UserOperation], tags=["User Services"])
+async def retrieve_users_batch(req: UserIdsBatch, service: RegisteredService = Depends(check_api_key)):
+    """Ritorna il dettaglio di più utenti con una sola query, con l'esito per ogni ID"""
+    valid = [user_id for user_id in req.ids if ObjectId.is_valid(user_id)]
+    found = {str(user.id): user for user in await user_repo.retrieve_many(valid, view=UserView)} if valid else {}
+    not_found = NotFound("User not found")
+    return DJSONResponse(content=[
+        user_operation(user_id, user=found[user_id]) if user_id in found
+        else user_operation(user_id, not_found if ObjectId.is_valid(user_id) else INVALID_ID)
+        for user_id in req.ids
+    ])
+
+
+@router.post("/users/delete-batch", response_model=List[UserOperation], tags=["User Services"])
+async def delete_users_batch(req: UserIdsBatch, service: RegisteredService = Depends(check_api_key)):
+    """Elimina più utenti con una sola operazione, con l'esito per ogni ID"""
+    valid = [user_id for user_id in req.ids if ObjectId.is_valid(user_id)]
+    deleted = {str(doc["_id"]) for doc in await user_repo.destroy_many(valid)} if valid else set()
+    gone = NotFound("User not found")
+    return DJSONResponse(content=[
+        user_operation(user_id) if user_id in deleted
+        else user_operation(user_id, gone if ObjectId.is_valid(user_id) else INVALID_ID)
+        for user_id in req.ids
+    ])
+
+
+@router.post("/users/update-batch", response_model=List[UserOperation], tags=["User Services"])
+async def update_users_batch(req: UserUpdatesBatch, service: RegisteredService = Depends(check_api_key)):
+    """Modifica più utenti con una sola scrittura, ritornando per ogni ID l'esito e l'utente aggiornato"""
+    positions = [position for position, user in enumerate(req.users) if ObjectId.is_valid(user.id)]
+    errors = await user_repo.bulk_partial_update([
+        (req.users[position].id, {
+            "username": req.users[position].username,
+            "password": req.users[position].password.get_secret_value() if req.users[position].password else None
+        })
+        for position in positions
+    ]) if positions else {}
+    failed = {positions[index]: exc for index, exc in errors.items()}
+    updated_ids = [req.users[position].id for position in positions if position not in failed]
+    updated = {str(user.id): user for user in await user_repo.retrieve_many(updated_ids, view=UserView)} if updated_ids else {}
+    content = []
+    for position, user in enumerate(req.users):
+        exc = failed.get(position) if ObjectId.is_valid(user.id) else INVALID_ID
+        content.append(user_operation(user.id, exc, user=updated.get(user.id) if exc is None else None))
+    return DJSONResponse(content=content)
 
 
 @router.post("/auth/signin", response_model=AuthenticatedUser, tags=["Authentication Services"])
 async def sign_in(credentials: Credentials, service: RegisteredService = Depends(check_api_key)):
     """Effettua il login dell'utente"""
-    return await sso.signin(**credentials.dict())
+    return DJSONResponse(content=encode_authenticated_user(await sso.signin(**credentials.dict(), service=str(service.id))))
 
 
 class UserExistenceRequest(BaseModel):
@@ -96,7 +239,7 @@ class UserExistenceRequest(BaseModel):
 @router.post("/auth/ues", response_model=AuthenticatedUser, tags=["Authentication Services"])
 async def user_existence_service(payload: UserExistenceRequest, service: RegisteredService = Depends(check_api_key)):
     """Verifica l'esistenza di un utente e lo autentica se possibile"""
-    return await sso.ues(payload.username)
+    return DJSONResponse(content=encode_authenticated_user(await sso.ues(payload.username)))
 
 class AuthTokenReq(BaseModel):
     access_token: str
@@ -113,16 +256,40 @@ async def sign_out(req: AuthTokenReq, service: RegisteredService = Depends(check
 async def verify(req: AuthTokenReq, service: RegisteredService = Depends(check_api_key)):
     """Verifica la validità di un token di autenticazione"""
     try:
-        await sso.verify(req.access_token)
-        return {"operation": True}
+        return {"operation": await sso.check(req.access_token)}
     except Forbidden:
         return {"operation": False}
 
 
+class BatchAuthTokenReq(BaseModel):
+    access_tokens: conlist(str, min_items=1, max_items=VERIFY_BATCH_MAX_TOKENS)
+    include_user: bool = False
+
+
+class TokenVerification(BaseModel):
+    access_token: str
+    operation: bool
+    user: Optional[ReadUser]
+
+
+@router.post("/auth/verify-batch", response_model=List[TokenVerification], tags=["Authentication Services"])
+async def verify_batch(req: BatchAuthTokenReq, service: RegisteredService = Depends(check_api_key)):
+    """Verifica la validità di più token di autenticazione, opzionalmente ritornando gli attributi degli utenti"""
+    verified = await sso.verify_batch(req.access_tokens)
+    return DJSONResponse(content=[
+        {
+            "access_token": access_token,
+            "operation": user is not None,
+            "user": encode_read_user(user) if user is not None and req.include_user else None
+        }
+        for access_token, user in zip(req.access_tokens, verified)
+    ])
+
+
 @router.post("/auth/sso", response_model=ReadUser, tags=["Authentication Services"])
 async def single_sign_on(req: AuthTokenReq, service: RegisteredService = Depends(check_api_key)):
     """Fornito l'access token ritorna gli attributi di un utente"""
-    return await sso.verify(req.access_token)
+    return DJSONResponse(content=encode_read_user(await sso.verify(req.access_token)))
 
 
 class RefreshReq(BaseModel):
@@ -133,4 +300,4 @@ class RefreshReq(BaseModel):
 async def refresh(refresh: RefreshReq, service: RegisteredService = Depends(check_api_key)):
     """Permette il refresh dell'autenticazione"""
     inst = await sso.refresh(refresh.refresh_token)
-    return inst
\ No newline at end of file
+    return DJSONResponse(content=encode_authenticated_user(inst))
\ No newline at end of file
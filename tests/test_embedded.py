@@ -0,0 +1,251 @@
+import os
+import asyncio
+import datetime
+import tempfile
+import unittest
+from bson import ObjectId
+from pymongo import IndexModel, ASCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from sso_service.embedded import EmbeddedStorage
+from sso_service.models import UserToken, token_query, token_unexpired
+
+
+USERNAME_UNIQUE = IndexModel([("username", ASCENDING)], name="username_unique", unique=True)
+ACCESS_KEY = IndexModel([("token.access_key", ASCENDING)], name="token_access_key")
+
+
+def user(username: str, **fields) -> dict:
+    return {"_id": ObjectId(), "username": username, **fields}
+
+
+def with_token(username: str, expires_in: float = 3600, is_valid: bool = True) -> dict:
+    token = UserToken(is_valid=is_valid).seal()
+    token.access_expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=expires_in)
+    return user(username, token=token.doc())
+
+
+class QueryTest(unittest.IsolatedAsyncioTestCase):
+    """Query shapes built by the repositories"""
+
+    async def asyncSetUp(self):
+        self.storage = EmbeddedStorage()
+        await self.storage.create_index("users", USERNAME_UNIQUE)
+        await self.storage.create_index("users", ACCESS_KEY)
+        self.alice = with_token("alice")
+        self.bob = with_token("bob", expires_in=-60)
+        self.carol = with_token("carol", is_valid=False)
+        self.dave = user("dave")
+        for doc in (self.alice, self.bob, self.carol, self.dave):
+            await self.storage.insert("users", doc)
+
+    async def usernames(self, query: dict, **options) -> list:
+        return [doc["username"] for doc in await self.storage.find("users", query, **options)]
+
+    async def test_token_query_by_value(self):
+        access_value = self.alice["token"]["access_value"]
+        self.assertEqual(await self.usernames(token_query("access", access_value)), ["alice"])
+
+    async def test_token_query_filters_expired_and_invalid(self):
+        for doc in (self.bob, self.carol):
+            self.assertEqual(await self.usernames(token_query("access", doc["token"]["access_value"])), [])
+
+    async def test_token_query_in_many_values(self):
+        values = [doc["token"]["access_value"] for doc in (self.alice, self.bob, self.carol)] + ["unknown"]
+        self.assertEqual(await self.usernames(token_query("access", *values)), ["alice"])
+
+    async def test_unexpired_matches_missing_expiry(self):
+        await self.storage.update("users", {"_id": self.bob["_id"]}, {"$unset": {"token.access_expires_at": 1}})
+        self.assertEqual(sorted(await self.usernames(token_unexpired("access"))), ["alice", "bob"])
+
+    async def test_in_or_and_ranges(self):
+        now = datetime.datetime.utcnow()
+        self.assertEqual(sorted(await self.usernames({"username": {"$in": ["alice", "dave", "eve"]}})), ["alice", "dave"])
+        self.assertEqual(
+            sorted(await self.usernames({"$or": [{"username": "bob"}, {"token.is_valid": False}]})), ["bob", "carol"]
+        )
+        self.assertEqual(
+            await self.usernames({"token.is_valid": True, "token.access_expires_at": {"$lt": now}}), ["bob"]
+        )
+        self.assertEqual(await self.usernames({"token.access_expires_at": {"$gt": now, "$lte": now}}), [])
+
+    async def test_missing_fields(self):
+        self.assertEqual(await self.usernames({"token": None}), ["dave"])
+        self.assertEqual(await self.usernames({"token.access_value": {"$exists": False}}), ["dave"])
+        self.assertEqual(len(await self.usernames({"token.is_valid": {"$ne": True}})), 2)
+        # Range operators never match missing fields or values of another type
+        self.assertNotIn("dave", await self.usernames({"token.access_expires_at": {"$lt": datetime.datetime.max}}))
+        self.assertEqual(await self.usernames({"username": {"$gt": 0}}), [])
+
+    async def test_id_pages(self):
+        first = await self.storage.find("users", {}, sort=[("_id", 1)], limit=2)
+        rest = await self.storage.find("users", {"_id": {"$gt": first[-1]["_id"]}}, sort=[("_id", 1)], limit=10)
+        self.assertEqual([doc["username"] for doc in first + rest], ["alice", "bob", "carol", "dave"])
+
+    async def test_projection(self):
+        doc = await self.storage.retrieve("users", {"username": "alice"}, {"token.access_value": 1, "_id": 0})
+        self.assertEqual(doc, {"token": {"access_value": self.alice["token"]["access_value"]}})
+
+    async def test_unsupported_operators(self):
+        with self.assertRaises(OperationFailure):
+            await self.storage.find("users", {"username": {"$regex": "^a"}})
+        with self.assertRaises(OperationFailure):
+            await self.storage.update("users", {"username": "alice"}, {"$push": {"roles": "admin"}})
+
+
+class IndexTest(unittest.IsolatedAsyncioTestCase):
+    """Unique constraints and index maintenance across writes"""
+
+    async def asyncSetUp(self):
+        self.storage = EmbeddedStorage()
+        await self.storage.create_index("users", USERNAME_UNIQUE)
+
+    async def test_duplicate_insert_is_rejected(self):
+        await self.storage.insert("users", user("alice"))
+        with self.assertRaises(DuplicateKeyError):
+            await self.storage.insert("users", user("alice"))
+        self.assertEqual(await self.storage.count("users", {}), 1)
+
+    async def test_duplicate_update_rolls_back(self):
+        alice, bob = user("alice", age=30), user("bob")
+        await self.storage.insert_many("users", [alice, bob])
+        with self.assertRaises(DuplicateKeyError):
+            await self.storage.update("users", {"_id": bob["_id"]}, {"$set": {"username": "alice", "age": 1}})
+        self.assertEqual((await self.storage.retrieve("users", {"_id": bob["_id"]}))["username"], "bob")
+        self.assertNotIn("age", await self.storage.retrieve("users", {"_id": bob["_id"]}))
+        self.assertEqual((await self.storage.retrieve("users", {"username": "alice"}))["_id"], alice["_id"])
+        self.assertEqual((await self.storage.retrieve("users", {"username": "bob"}))["_id"], bob["_id"])
+
+    async def test_insert_many_reports_positions(self):
+        await self.storage.insert("users", user("alice"))
+        errors = await self.storage.insert_many("users", [user("bob"), user("alice"), user("carol"), user("bob")])
+        self.assertEqual(sorted(errors), [1, 3])
+        self.assertEqual(await self.storage.count("users", {}), 3)
+
+    async def test_bulk_update_reports_positions(self):
+        alice, bob = user("alice"), user("bob")
+        await self.storage.insert_many("users", [alice, bob])
+        errors = await self.storage.bulk_update("users", [
+            ({"_id": alice["_id"]}, {"$set": {"username": "bob"}}),
+            ({"_id": bob["_id"]}, {"$set": {"username": "robert"}}),
+        ])
+        self.assertEqual(list(errors), [0])
+        self.assertEqual(sorted(doc["username"] for doc in await self.storage.find("users", {})), ["alice", "robert"])
+
+    async def test_update_and_fetch_moves_index_entries(self):
+        alice = user("alice")
+        await self.storage.insert("users", alice)
+        after = await self.storage.update_and_fetch("users", {"username": "alice"}, {"$set": {"username": "alicia"}})
+        self.assertEqual(after["username"], "alicia")
+        self.assertIsNone(await self.storage.retrieve("users", {"username": "alice"}))
+        self.assertEqual((await self.storage.retrieve("users", {"username": "alicia"}))["_id"], alice["_id"])
+        # The old value is free again, the new one is taken
+        await self.storage.insert("users", user("alice"))
+        with self.assertRaises(DuplicateKeyError):
+            await self.storage.insert("users", user("alicia"))
+
+    async def test_update_and_fetch_before(self):
+        await self.storage.insert("users", user("alice", logins=1))
+        before = await self.storage.update_and_fetch("users", {"username": "alice"}, {"$inc": {"logins": 1}}, before=True)
+        self.assertEqual(before["logins"], 1)
+        self.assertEqual((await self.storage.retrieve("users", {"username": "alice"}))["logins"], 2)
+        self.assertIsNone(await self.storage.update_and_fetch("users", {"username": "eve"}, {"$set": {"a": 1}}, upsert=True, before=True))
+        self.assertIsNotNone(await self.storage.retrieve("users", {"username": "eve"}))
+
+    async def test_delete_many_removes_index_entries(self):
+        docs = [user(f"user{i}") for i in range(5)]
+        await self.storage.insert_many("users", docs)
+        deleted = await self.storage.delete("users", {"_id": {"$in": [doc["_id"] for doc in docs[:3]]}}, multi=True)
+        self.assertEqual(deleted, 3)
+        self.assertEqual(await self.storage.find("users", {"username": {"$in": ["user0", "user1", "user2"]}}), [])
+        self.assertEqual(await self.storage.count("users", {"username": {"$in": ["user3", "user4"]}}), 2)
+        await self.storage.insert_many("users", [user("user0"), user("user1")])
+        self.assertEqual(await self.storage.count("users", {}), 4)
+
+    async def test_unique_index_on_existing_duplicates(self):
+        await self.storage.insert_many("users", [user("alice", email="a@x"), user("bob", email="a@x")])
+        with self.assertRaises(DuplicateKeyError):
+            await self.storage.create_index("users", IndexModel([("email", ASCENDING)], name="email_unique", unique=True))
+        self.assertNotIn("email_unique", await self.storage.index_information("users"))
+
+
+class PersistenceTest(unittest.IsolatedAsyncioTestCase):
+    """Append-only log replay and compaction"""
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "data.bson")
+        self.storage = await self.open()
+
+    async def asyncTearDown(self):
+        await self.storage.close()
+        self.directory.cleanup()
+
+    async def open(self, **options) -> EmbeddedStorage:
+        storage = EmbeddedStorage(self.path, **options)
+        storage.open()
+        return storage
+
+    async def reopen(self, **options) -> EmbeddedStorage:
+        await self.storage.close()
+        self.storage = await self.open(**options)
+        return self.storage
+
+    async def test_replay_after_reopen(self):
+        await self.storage.create_index("users", USERNAME_UNIQUE)
+        await self.storage.create_index("users", ACCESS_KEY)
+        alice, bob, carol = user("alice"), user("bob"), user("carol")
+        await self.storage.insert_many("users", [alice, bob, carol])
+        await self.storage.update("users", {"_id": alice["_id"]}, {"$set": {"username": "alicia"}})
+        await self.storage.delete("users", {"_id": bob["_id"]})
+        await self.storage.drop_index("users", "token_access_key")
+        storage = await self.reopen()
+        self.assertEqual(sorted(doc["username"] for doc in await storage.find("users", {})), ["alicia", "carol"])
+        self.assertEqual(sorted(await storage.index_information("users")), ["_id_", "username_unique"])
+        with self.assertRaises(DuplicateKeyError):
+            await storage.insert("users", user("carol"))
+
+    async def test_truncated_record_is_dropped(self):
+        await self.storage.insert("users", user("alice"))
+        self.storage._file.write(b"\x40\x00\x00\x00\x02partial")
+        self.storage._file.flush()
+        self.storage._file.close()
+        self.storage._file = None
+        storage = await self.reopen()
+        self.assertEqual([doc["username"] for doc in await storage.find("users", {})], ["alice"])
+        await storage.insert("users", user("bob"))
+        storage = await self.reopen()
+        self.assertEqual(await storage.count("users", {}), 2)
+
+    async def test_compaction_during_writes(self):
+        storage = await self.reopen(compact_ratio=1)
+        await storage.create_index("users", USERNAME_UNIQUE)
+        docs = [user(f"user{i}", version=0) for i in range(10)]
+        await storage.insert_many("users", docs)
+        version = 0
+        while storage.compaction is None:
+            version += 1
+            await storage.update("users", {"_id": docs[version % 10]["_id"]}, {"$set": {"version": version}})
+        # Writes logged while the snapshot is written in a thread are appended to it
+        await storage.update("users", {"_id": docs[0]["_id"]}, {"$set": {"version": -1}})
+        await storage.delete("users", {"_id": docs[1]["_id"]})
+        await storage.insert("users", user("late"))
+        await storage.compaction
+        await storage.update("users", {"_id": docs[2]["_id"]}, {"$set": {"version": -2}})
+        self.assertLess(storage.records, 100)
+        expected = {doc["username"]: doc.get("version") for doc in await storage.find("users", {})}
+        # Replays the compacted log as a crash would leave it, without the final compaction of close
+        replica = EmbeddedStorage(self.path)
+        replica.load()
+        self.assertEqual({doc["username"]: doc.get("version") for doc in await replica.find("users", {})}, expected)
+        self.assertEqual(expected["user0"], -1)
+        self.assertEqual(expected["user2"], -2)
+        self.assertNotIn("user1", expected)
+        self.assertIn("late", expected)
+
+    async def test_single_owner(self):
+        with self.assertRaises(RuntimeError):
+            await self.open()
+
+
+if __name__ == "__main__":
+    unittest.main()